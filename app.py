@@ -1,20 +1,33 @@
 import uvicorn
+from asyncio import ensure_future
 from fastapi import FastAPI
 from fastapi.responses import PlainTextResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
 from bobstats.router import router as stats_router
 from supply.router import router as supply_router
 from supply.web import TotalSupply
 from bobvault.router import router as vault_router
+from profiling.router import router as profiling_router
+from events.router import router as events_router
 
 from utils.logging import LoggerProvider
 from utils.settings import Settings
 from utils.health import HealthRegistry, HealthOut
+from utils.watcher import SnapshotWatcher
+from utils.admission import AdmissionControl
+from utils.persistence import WriteBehind
+from utils.profiling import RequestProfiling
+from utils.events import EventBroker
 
 settings = Settings.get()
 app = FastAPI(docs_url=None, redoc_url=None)
 
+app.add_middleware(RequestProfiling)
+# Added before CORS, so rejected requests get CORS headers too
+# Event streams stay open for long, they are not counted as requests being served
+app.add_middleware(AdmissionControl, streaming=['/events'])
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"]
@@ -23,6 +36,8 @@ app.add_middleware(
 app.include_router(stats_router, prefix="/bobstats")
 app.include_router(vault_router, prefix="/coingecko/bobvault")
 app.include_router(supply_router, prefix="/supply")
+app.include_router(profiling_router, prefix="/profiling")
+app.include_router(events_router, prefix="/events")
 
 # @app.get("/", response_class=RedirectResponse)
 # async def root() -> str:
@@ -38,11 +53,28 @@ async def legacy_bobstat() -> str:
 
 @app.get("/health", response_model=HealthOut, response_model_exclude_none=True)
 async def health():
-    return HealthRegistry().publish()
+    # Not limited by the bounded executor, so health is reported even when it is busy
+    return await run_in_threadpool(HealthRegistry().publish)
 
 @app.on_event("startup")
 async def startup_event():
     LoggerProvider().switch_to_uvicorn()
+    settings.log()
+    WriteBehind()
+    EventBroker().start()
+    ensure_future(SnapshotWatcher().run())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Uploads already answered must reach the storage before the worker exits
+    await run_in_threadpool(WriteBehind().flush, settings.write_behind_flush_timeout)
 
 if __name__ == '__main__':
-    uvicorn.run(app, host="0.0.0.0", port=settings.port, proxy_headers=True)
\ No newline at end of file
+    # uvicorn is able to spawn several workers only if the app is passed as an import string
+    uvicorn.run(
+        "app:app" if settings.workers > 1 else app,
+        host="0.0.0.0",
+        port=settings.port,
+        proxy_headers=True,
+        workers=settings.workers
+    )
\ No newline at end of file
@@ -1,5 +1,5 @@
 from decimal import Decimal
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 from pydantic import Extra, BaseModel, Field
 
@@ -37,15 +37,13 @@ class GainStats(BaseModel):
 
     def adjust(self, source):
         def adjust_gain_set(fees_source: GainSet, fees_target: GainSet):
+            index = {target.symbol: target for target in fees_target}
             for f in fees_source:
-                found = False
-                for target in fees_target:
-                    if target.symbol == f.symbol:
-                        found = True
-                        target.amount += f.amount
-                        break
-                if not found:
+                if f.symbol in index:
+                    index[f.symbol].amount += f.amount
+                else:
                     fees_target.append(f)
+                    index[f.symbol] = f
             
         if not source.is_fees_empty():
             if not self.fees:
@@ -63,6 +61,9 @@ class GainStatsAPI(TimestampedBaseModel, extra=Extra.forbid):
     timestamp: int
     gain: GainStatsTimeStamped = Field(..., alias='yield') 
 
+class GainStatsSourcesAPI(TimestampedBaseModel, extra=Extra.forbid):
+    sources: Dict[str, GainStatsTimeStamped]
+
 class BobStatsPeriodDataAPI(TimestampedBaseModel):
     totalSupply: Decimal
     collaterisedCirculatedSupply: Decimal
@@ -80,3 +81,38 @@ class BobStatsDataForTwoPeriodsToFeed(TimestampedBaseModel, extra=Extra.forbid):
     current: BobStatsPeriodDataToFeed
     previous: BobStatsPeriodDataToFeed
 
+
+class BobStatsDeltas(BaseModel):
+    totalSupply: Decimal
+    collaterisedCirculatedSupply: Decimal
+    volumeUSD: Decimal
+    holders: int
+
+class BobStatsHistoryPoint(BobStatsPeriodDataAPI):
+    gain: Optional[GainStats] = Field(None, alias='yield')
+    deltas: BobStatsDeltas # current period against the previous one
+
+    class Config:
+        allow_population_by_field_name = True
+
+    @classmethod
+    def from_feed(cls, data: BobStatsDataForTwoPeriodsToFeed) -> 'BobStatsHistoryPoint':
+        current = data.current
+        previous = data.previous
+        return cls(
+            timestamp=current.timestamp,
+            totalSupply=current.totalSupply,
+            collaterisedCirculatedSupply=current.collaterisedCirculatedSupply,
+            volumeUSD=current.volumeUSD,
+            holders=current.holders,
+            gain=current.gain,
+            deltas=BobStatsDeltas(
+                totalSupply=current.totalSupply - previous.totalSupply,
+                collaterisedCirculatedSupply=current.collaterisedCirculatedSupply - previous.collaterisedCirculatedSupply,
+                volumeUSD=current.volumeUSD - previous.volumeUSD,
+                holders=current.holders - previous.holders
+            )
+        )
+
+class BobStatsHistoryAPI(TimestampedBaseModel):
+    history: List[BobStatsHistoryPoint]
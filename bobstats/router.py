@@ -1,11 +1,20 @@
-from fastapi import APIRouter, Security
+from fastapi import APIRouter, Request, Security
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from starlette.concurrency import run_in_threadpool
+
+from asyncio import ensure_future
 
 from .web import BobStats
-from .models import BobStatsDataForTwoPeriodsAPI, BobStatsDataForTwoPeriodsToFeed, GainStatsAPI
+from .models import BobStatsDataForTwoPeriodsAPI, BobStatsDataForTwoPeriodsToFeed, GainStatsAPI, \
+    BobStatsHistoryAPI, GainStatsSourcesAPI, GainStatsTimeStamped
 
-from utils.misc import check_auth_token
+from utils.misc import check_auth_token, MINTIMESTAMP, MAXTIMESTAMP
 from utils.models import UploadResponse
+from utils.executor import BoundedExecutor, parse_body
+from utils.compression import read_body, compressed_response
+from utils.settings import Settings
+
+_settings = Settings.get()
 
 _security = HTTPBearer()
 
@@ -13,21 +22,79 @@ router = APIRouter()
 
 @router.get("/", response_model=BobStatsDataForTwoPeriodsAPI)
 async def provide() -> BobStatsDataForTwoPeriodsAPI:
-    return BobStats().loadMainStat()
+    return await BoundedExecutor().run(BobStats().loadMainStat)
 
 @router.get("/yield", response_model=GainStatsAPI, response_model_exclude_unset=True)
 async def provide() -> GainStatsAPI:
-    return BobStats().loadYieldStat()
+    return await BoundedExecutor().run(BobStats().loadYieldStat)
+
+@router.get("/yield/sources", response_model=GainStatsSourcesAPI, response_model_exclude_unset=True)
+async def provide_sources() -> GainStatsSourcesAPI:
+    return await BoundedExecutor().run(BobStats().loadYieldSources)
+
+@router.post("/yield/{source}/upload", response_model=UploadResponse)
+async def upload_yield(source: str, request: Request, \
+                       credentials: HTTPAuthorizationCredentials = Security(_security)) -> UploadResponse:
+    if not check_auth_token(credentials.credentials):
+        return UploadResponse(status="Incorrect auth token")
+
+    if source == _settings.bobstat_main_yield_source:
+        return UploadResponse(status="Incorrect source")
+
+    executor = BoundedExecutor()
+    body = await read_body(request)
+    data = await executor.run(
+        parse_body,
+        GainStatsTimeStamped,
+        body,
+        request.headers.get('content-encoding'),
+        timeout=_settings.executor_upload_timeout
+    )
+    await executor.run(BobStats().store_yield, source, data, timeout=_settings.executor_upload_timeout)
+    return UploadResponse(status="success")
+
+@router.delete("/yield/{source}", response_model=UploadResponse)
+async def remove_yield(source: str, \
+                       credentials: HTTPAuthorizationCredentials = Security(_security)) -> UploadResponse:
+    if not check_auth_token(credentials.credentials):
+        return UploadResponse(status="Incorrect auth token")
+
+    if source == _settings.bobstat_main_yield_source:
+        return UploadResponse(status="Incorrect source")
+
+    removed = await BoundedExecutor().run(BobStats().remove_yield, source, timeout=_settings.executor_upload_timeout)
+    return UploadResponse(status="success" if removed else "Unknown source")
+
+@router.get("/history", response_model=BobStatsHistoryAPI, response_model_exclude_none=True)
+async def history(request: Request,
+                  start_time: int = MINTIMESTAMP,
+                  end_time: int = MAXTIMESTAMP,
+                  limit: int = 0) -> BobStatsHistoryAPI:
+    executor = BoundedExecutor()
+    output = await executor.run(BobStats().history, start_time, end_time, limit)
+    return await executor.run(compressed_response, request, output, exclude_none=True)
 
 @router.post("/upload", response_model=UploadResponse)
-async def upload(data: BobStatsDataForTwoPeriodsToFeed, \
+async def upload(request: Request, \
                  credentials: HTTPAuthorizationCredentials = Security(_security)) -> UploadResponse:
     if not check_auth_token(credentials.credentials):
         return UploadResponse(status="Incorrect auth token")
 
-    BobStats().store(data)
+    # The body is parsed in the pool rather than by FastAPI in the event loop
+    executor = BoundedExecutor()
+    body = await read_body(request)
+    data = await executor.run(
+        parse_body,
+        BobStatsDataForTwoPeriodsToFeed,
+        body,
+        request.headers.get('content-encoding'),
+        timeout=_settings.executor_upload_timeout
+    )
+    await executor.run(BobStats().store, data, timeout=_settings.executor_upload_timeout)
     return UploadResponse(status="success")
 
 @router.on_event("startup")
 async def startup_event():
-    BobStats()
+    # Only the data timestamps are read here, the data itself
+    # is loaded in background to open the port sooner
+    ensure_future(run_in_threadpool(BobStats().warm_up))
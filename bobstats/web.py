@@ -1,71 +1,307 @@
 from functools import cache
 from time import time
-from json import dump, load
+from typing import NamedTuple, Optional, List, Dict, Tuple
 from decimal import Decimal
+from bisect import bisect_left, bisect_right
+from threading import Lock, RLock
 
 from pydantic import ValidationError
 
 from .models import *
+from .yields import YieldAggregator
 
 from utils.logging import info, error, warning
 from utils.settings import Settings
 from utils.health import Health, HealthRegistry
-from utils.misc import CustomJSONEncoder
+from utils.storage import document_storage
+from utils.watcher import SnapshotWatcher
+from utils.persistence import WriteBehind
+from utils.events import EventBroker
+from utils.profiling import Profiler
+from utils.misc import MINTIMESTAMP, MAXTIMESTAMP
 
 _settings = Settings.get()
 
+class BobStatsSnapshot(NamedTuple):
+    main: BobStatsDataForTwoPeriodsAPI
+    gain: Optional[GainStatsTimeStamped]
+
+class BobStatsHistory(NamedTuple):
+    timestamps: List[int] # sorted, used to find a range of points
+    points: List[BobStatsHistoryPoint]
+
+    @classmethod
+    def from_points(cls, points: Dict[int, BobStatsHistoryPoint]) -> 'BobStatsHistory':
+        timestamps = sorted(points.keys())
+        return cls(timestamps, [points[ts] for ts in timestamps])
+
 @cache
 class BobStats(Health):
+    _snapshot: Optional[BobStatsSnapshot]
+    _history: BobStatsHistory
+    _history_records: int
+    topic = 'bobstats'
 
     def __init__(self):
-        self.filename = f'{_settings.snapshot_dir}/{_settings.bobstat_snapshot_file}'
+        self.key = _settings.bobstat_snapshot_file
+        self.history_key = _settings.bobstat_history_file
+        self.yield_sources_key = _settings.bobstat_yield_sources_file
+        self._storage = document_storage()
+
+        self._snapshot = None
+        self._seen_version = None
+        self._seen_yield_sources_version = None
+        self.yields = YieldAggregator()
+        self._history = BobStatsHistory([], [])
+        self._history_records = 0
+        self._loaded = False
+        self._load_lock = Lock()
+        # Uploads stored and written to the storage so far, a reload never replaces newer uploads
+        self._swap_lock = RLock()
+        self._generation = 0
+        self._saved_generation = 0
+        self._yield_generation = 0
+        self._saved_yield_generation = 0
 
         info(f'Checking for available bob statistics')
         self.initialize_healthdata()
         HealthRegistry().append(self)
+        SnapshotWatcher().watch(self._storage.source(self.key), self)
+        if self._storage.source(self.yield_sources_key) != self._storage.source(self.key):
+            SnapshotWatcher().watch(self._storage.source(self.yield_sources_key), self)
+        Profiler().register_load_path(self.name(), lambda: self._parse(self._load_json_as_dict()))
+        Profiler().register_load_path(f'{self.name()}/history', lambda: self._storage.load_records(self.history_key))
+
+    def _dump(self, data: BobStatsDataForTwoPeriodsToFeed, generation: int):
+        self._storage.save(self.key, data.dict(exclude_unset=True))
+        with self._swap_lock:
+            self._seen_version = self._storage.version(self.key)
+            self._saved_generation = max(self._saved_generation, generation)
 
-    def _dump(self, data: BobStatsDataForTwoPeriodsToFeed):
-        with open(self.filename, 'w') as json_file:
-            dump(data.dict(exclude_unset=True), json_file, cls=CustomJSONEncoder)
+    def _dump_yield_sources(self, sources: dict, generation: int):
+        self._storage.save(self.yield_sources_key, sources)
+        with self._swap_lock:
+            self._seen_yield_sources_version = self._storage.version(self.yield_sources_key)
+            self._saved_yield_generation = max(self._saved_yield_generation, generation)
 
     def _load_json_as_dict(self) -> dict:
         try:
-            with open(self.filename, 'r') as json_file:
-                data = load(json_file)
-            return data
+            return self._storage.load(self.key)
         except IOError as e:
-            warning(f'No snapshot {self.filename} found')
+            warning(f'No snapshot {self.key} found')
             raise e
 
-    def _loadMainStat(self) -> BobStatsDataForTwoPeriodsAPI:
-        data = self._load_json_as_dict()
+    def _parse(self, data: dict) -> BobStatsSnapshot:
         try:
-            return BobStatsDataForTwoPeriodsAPI.parse_obj(data)
+            main = BobStatsDataForTwoPeriodsAPI.parse_obj(data)
         except ValidationError as e:
             error(f'Cannot parse snapshot data')
             raise e
 
-    def _loadYieldStat(self) -> GainStatsTimeStamped:
-        data = self._load_json_as_dict()
-        info(f"{type(data)}")
+        gain = None
+        if 'gain' in data['current']:
+            try:
+                out = dict(data['current']['gain'])
+                out['timestamp'] = data['current']['timestamp']
+                gain = GainStatsTimeStamped.parse_obj(out)
+            except ValidationError as e:
+                error(f'Cannot parse yield data in snapshot')
+
+        return BobStatsSnapshot(main, gain)
+
+    @staticmethod
+    def _history_points(records: List[dict]) -> Dict[int, BobStatsHistoryPoint]:
+        # The log is append-only, a re-upload of the same period replaces
+        # the previous point for the period when the log is read
+        points = {}
+        for r in records:
+            try:
+                point = BobStatsHistoryPoint.parse_obj(r)
+            except ValidationError:
+                error(f'Cannot parse bob statistics history record')
+                continue
+            points[point.timestamp] = point
+        return points
+
+    def _read_history(self) -> Tuple[int, BobStatsHistory]:
+        records = self._storage.load_records(self.history_key)
+        points = self._history_points(records)
+        info(f'{len(points)} points of bob statistics history loaded')
+        return len(records), BobStatsHistory.from_points(points)
+
+    def _load_history(self):
+        self._history_records, self._history = self._read_history()
+
+    def _compact_history(self, records: List[dict]) -> List[dict]:
+        points = self._history_points(records)
+        return [points[ts].dict(exclude_none=True) for ts in sorted(points.keys())]
+
+    def _load_yield_sources(self) -> bool:
+        """Yields uploaded by additional feeders, the main feeder yield is kept in the snapshot
+
+        False if nothing is loaded, also when a yield stored in memory is not written yet.
+        """
+        generation = self._yield_generation
+        if generation != self._saved_yield_generation:
+            return False
+        version = self._storage.version(self.yield_sources_key)
         try:
-            out = data['current']['gain']
-            out['timestamp'] = data['current']['timestamp']
-            return GainStatsTimeStamped.parse_obj(out)
-        except ValidationError as e:
-            error(f'Cannot parse snapshot data')
-            raise e
+            sources = self._storage.load(self.yield_sources_key)
+        except IOError:
+            self._seen_yield_sources_version = version
+            return False
+        parsed = {}
+        for source, gain in sources.items():
+            try:
+                parsed[source] = GainStatsTimeStamped.parse_obj(gain)
+            except ValidationError:
+                error(f'Cannot parse yield data of {source}')
+        with self._swap_lock:
+            if generation != self._yield_generation:
+                return False
+            self._seen_yield_sources_version = version
+            for source in set(self.yields.sources().keys()) - set(sources.keys()) - {_settings.bobstat_main_yield_source}:
+                self.yields.update(source, None)
+            for source, gain in parsed.items():
+                self.yields.update(source, gain)
+        return True
+
+    def _load_timestamp(self) -> int:
+        return self._load_json_as_dict()['timestamp']
+
+    def warm_up(self):
+        with self._load_lock:
+            if self._loaded:
+                return
+            info(f'Loading bob statistics')
+            self._load_history()
+            self._load_yield_sources()
+            try:
+                self._load()
+            except:
+                pass
+            self._loaded = True
+
+    def _ensure_loaded(self):
+        # The data is loaded by the warm-up task, a request arriving earlier loads it itself
+        if not self._loaded:
+            self.warm_up()
+
+    def _load(self, with_history: bool = False) -> Optional[BobStatsDataForTwoPeriodsAPI]:
+        """None if an upload stored in memory is newer than the snapshot in the storage"""
+        generation = self._generation
+        if generation != self._saved_generation:
+            return None
+        version = self._storage.version(self.key)
+        history = self._read_history() if with_history else None
+        data = self._load_json_as_dict()
+        snapshot = self._parse(data)
+
+        with self._swap_lock:
+            if generation != self._generation:
+                info(f'Bob statistics were uploaded while loading, the loaded data is dropped')
+                return None
+            if history is not None:
+                self._history_records, self._history = history
+            self._seen_version = version
+            self._snapshot = snapshot
+            self.yields.update(_settings.bobstat_main_yield_source, snapshot.gain)
 
-    def _load(self) -> BobStatsDataForTwoPeriodsAPI:
-        return self._loadMainStat()
+            # Snapshots uploaded before the history was introduced
+            if not snapshot.main.current.timestamp in self._history.timestamps:
+                try:
+                    self._add_to_history(BobStatsDataForTwoPeriodsToFeed.parse_obj(data))
+                except ValidationError:
+                    pass
+
+        return snapshot.main
+
+    def _add_to_history(self, data: BobStatsDataForTwoPeriodsToFeed) -> BobStatsHistoryPoint:
+        point = BobStatsHistoryPoint.from_feed(data)
+        points = dict(zip(self._history.timestamps, self._history.points))
+        points[point.timestamp] = point
+        self._history = BobStatsHistory.from_points(points)
+        return point
+
+    def _append_history(self, data: BobStatsDataForTwoPeriodsToFeed):
+        point = self._add_to_history(data)
+        self._storage.append_record(self.history_key, point.dict(exclude_none=True))
+        self._history_records += 1
+
+        if self._history_records > 2 * len(self._history.points):
+            info(f'Compacting bob statistics history')
+            # The log is re-read under the storage lock, records appended
+            # by other workers since it was loaded here are kept
+            records = self._storage.compact_records(self.history_key, self._compact_history)
+            self._history_records = len(records)
+            self._history = BobStatsHistory.from_points(self._history_points(records))
+
+    def sync(self):
+        if not self._loaded:
+            return
+        if self._storage.version(self.yield_sources_key) != self._seen_yield_sources_version:
+            info(f'Yield sources {self.yield_sources_key} changed, reloading')
+            if self._load_yield_sources():
+                self.publish_event(self.healthdata.dataTimestamp)
+        # The snapshot could be replaced by another worker or replica
+        if self._storage.version(self.key) == self._seen_version:
+            return
+        info(f'Snapshot {self.key} changed, reloading')
+        try:
+            data = self._load(with_history=True)
+        except:
+            return
+        if data is not None:
+            self.record_sucess(data.timestamp)
 
     def store(self, data: BobStatsDataForTwoPeriodsToFeed):
         info(f'New bobstat data stamped as {data.timestamp} received')
+        self._ensure_loaded()
+
+        snapshot = self._parse(data.dict(exclude_unset=True))
+        with self._swap_lock:
+            self._generation += 1
+            # The history is written first: other workers reload it once
+            # they notice the new snapshot. The snapshot is written in background.
+            self._append_history(data)
+            WriteBehind().submit((type(self).__name__, self.key), self._dump, data, self._generation)
+            self._snapshot = snapshot
+            self.yields.update(_settings.bobstat_main_yield_source, snapshot.gain)
 
-        self._dump(data)
-        
         self.record_sucess(data.timestamp)
 
+    def store_yield(self, source: str, gain: GainStatsTimeStamped):
+        info(f'New yield data of {source} stamped as {gain.timestamp} received')
+        self._ensure_loaded()
+
+        self._update_yield(source, gain)
+        EventBroker().publish(self.topic, {'dataTimestamp': gain.timestamp, 'yieldSource': source})
+
+    def remove_yield(self, source: str) -> bool:
+        """Drops a source which stopped reporting, False if the source is not known"""
+        info(f'Removing yield data of {source}')
+        self._ensure_loaded()
+
+        with self._swap_lock:
+            if source not in self.yields.sources():
+                return False
+            self._update_yield(source, None)
+        EventBroker().publish(self.topic, {'dataTimestamp': self.yields.combined().timestamp, 'yieldSource': source})
+        return True
+
+    def _update_yield(self, source: str, gain: Optional[GainStatsTimeStamped]):
+        with self._swap_lock:
+            self._yield_generation += 1
+            self.yields.update(source, gain)
+            sources = self.yields.sources()
+            sources.pop(_settings.bobstat_main_yield_source, None)
+            WriteBehind().submit(
+                (type(self).__name__, self.yield_sources_key),
+                self._dump_yield_sources,
+                {s: g.dict(exclude_unset=True) for s, g in sources.items()},
+                self._yield_generation
+            )
+
     def loadMainStat(self) -> BobStatsDataForTwoPeriodsAPI:
         ts_checkpoint = int(time())
 
@@ -84,13 +320,12 @@ class BobStats(Health):
             previous=empty_period
         )
 
-        try:
-            data = self._loadMainStat()
-            data.timestamp=ts_checkpoint
-        except:
+        self._ensure_loaded()
+        snapshot = self._snapshot
+        if snapshot is None:
             return empty_response
 
-        return data
+        return snapshot.main.copy(update={'timestamp': ts_checkpoint})
 
     def loadYieldStat(self) -> GainStatsAPI:
         ts_checkpoint = int(time())
@@ -103,12 +338,28 @@ class BobStats(Health):
             )
         })
 
-        try:
-            data = GainStatsAPI(**{
-                'timestamp': ts_checkpoint,
-                'yield': self._loadYieldStat()
-            })
-        except:
+        self._ensure_loaded()
+        if self.yields.is_empty():
             return empty_response
 
-        return data
+        return GainStatsAPI(**{
+            'timestamp': ts_checkpoint,
+            'yield': self.yields.combined()
+        })
+
+    def loadYieldSources(self) -> GainStatsSourcesAPI:
+        self._ensure_loaded()
+        return GainStatsSourcesAPI(timestamp=int(time()), sources=self.yields.sources())
+
+    def history(self, start_time: int, end_time: int, limit: int) -> BobStatsHistoryAPI:
+        self._ensure_loaded()
+        history = self._history
+        if limit != 0 and start_time == MINTIMESTAMP and end_time == MAXTIMESTAMP:
+            points = history.points[-limit:]
+        else:
+            first = bisect_left(history.timestamps, start_time)
+            last = bisect_right(history.timestamps, end_time)
+            if limit != 0:
+                last = min(last, first + limit)
+            points = history.points[first:last]
+        return BobStatsHistoryAPI(timestamp=int(time()), history=points)
@@ -0,0 +1,99 @@
+from typing import Dict, NamedTuple, Optional
+from decimal import Decimal
+from threading import Lock
+
+from .models import GainSet, GainStatsTimeStamped, OneTokenAcc
+
+SymbolAmounts = Dict[str, Decimal]
+
+def _index(gain_set: Optional[GainSet]) -> Optional[SymbolAmounts]:
+    if gain_set is None:
+        return None
+    index = {}
+    for acc in gain_set:
+        index[acc.symbol] = index.get(acc.symbol, Decimal(0)) + acc.amount
+    return index
+
+def _gain_set(amounts: SymbolAmounts) -> GainSet:
+    return [OneTokenAcc(symbol=symbol, amount=amount) for symbol, amount in amounts.items()]
+
+class YieldSource(NamedTuple):
+    gain: GainStatsTimeStamped
+    fees: SymbolAmounts
+    interest: Optional[SymbolAmounts]
+
+class SymbolTotals():
+    """Sums of amounts per symbol, with the number of sources reporting every symbol"""
+
+    def __init__(self):
+        self.amounts = {}
+        self._refs = {}
+
+    def add(self, amounts: Optional[SymbolAmounts]):
+        for symbol, amount in (amounts or {}).items():
+            self.amounts[symbol] = self.amounts.get(symbol, Decimal(0)) + amount
+            self._refs[symbol] = self._refs.get(symbol, 0) + 1
+
+    def subtract(self, amounts: Optional[SymbolAmounts]):
+        for symbol, amount in (amounts or {}).items():
+            self._refs[symbol] -= 1
+            if self._refs[symbol] == 0:
+                del self._refs[symbol]
+                del self.amounts[symbol]
+            else:
+                self.amounts[symbol] -= amount
+
+class YieldAggregator():
+    """Combines yields reported by several sources (feeders or chains)
+
+    Amounts are accumulated in maps indexed by symbol, so an upload from one
+    source only subtracts its previous contribution and adds the new one.
+    Decimal arithmetic keeps the combined amounts exact.
+    """
+    _sources: Dict[str, YieldSource]
+
+    def __init__(self):
+        self._sources = {}
+        self._fees = SymbolTotals()
+        self._interest = SymbolTotals()
+        self._interest_sources = 0
+        self._lock = Lock()
+
+    def update(self, source: str, gain: Optional[GainStatsTimeStamped]):
+        with self._lock:
+            self._update(source, gain)
+
+    def _update(self, source: str, gain: Optional[GainStatsTimeStamped]):
+        previous = self._sources.pop(source, None)
+        if previous:
+            self._fees.subtract(previous.fees)
+            self._interest.subtract(previous.interest)
+            if previous.interest is not None:
+                self._interest_sources -= 1
+        if gain is None:
+            return
+
+        current = YieldSource(gain, _index(gain.fees), _index(gain.interest))
+        self._fees.add(current.fees)
+        self._interest.add(current.interest)
+        if current.interest is not None:
+            self._interest_sources += 1
+        self._sources[source] = current
+
+    def is_empty(self) -> bool:
+        return len(self._sources) == 0
+
+    def sources(self) -> Dict[str, GainStatsTimeStamped]:
+        with self._lock:
+            return {name: s.gain for name, s in self._sources.items()}
+
+    def combined(self) -> GainStatsTimeStamped:
+        with self._lock:
+            # Combined yield is as recent as the oldest source
+            combined = {
+                'timestamp': min([s.gain.timestamp for s in self._sources.values()], default=0),
+                'fees': _gain_set(self._fees.amounts)
+            }
+            if self._interest_sources > 0:
+                combined['interest'] = _gain_set(self._interest.amounts)
+        return GainStatsTimeStamped(**combined)
@@ -5,11 +5,7 @@ import copy
 
 from pydantic import Extra, BaseModel, root_validator, ValidationError
 
-class ModelWithJSONEncoder(BaseModel):
-    class Config:
-        json_encoders = {
-            Decimal: lambda v: str(v)
-        }
+from utils.models import ModelWithJSONEncoder
 
 class PairOrderbookModel(ModelWithJSONEncoder):
     bids: List[List[Decimal]] = [[]] #TODO Limit the list with two elements only
@@ -69,9 +65,7 @@ class BobVaultDataModel(ModelWithJSONEncoder):
         return output['__root__']
 
     def pairs(self) -> List:
-        keys = set(self.keys())
-        keys.discard('timestamp')
-        return list(keys)
+        return [k for k in self.keys() if k != 'timestamp']
 
     def __iter__(self):
         return iter(self.__root__)
@@ -121,3 +115,17 @@ class ListOfTickersOut(ModelWithJSONEncoder):
 class OrderbookOut(PairOrderbookModel):
     ticker_id: str = ""
     timestamp: Decimal = Decimal(0) # in fact, this is str(int)
+
+class ChainOrderbooksOut(ModelWithJSONEncoder):
+    timestamp: int # of the snapshot all the orderbooks come from
+    orderbooks: Dict[str, OrderbookOut]
+
+class BulkOrderbooksOut(ModelWithJSONEncoder):
+    chains: Dict[str, ChainOrderbooksOut] = {}
+
+class ChainTradesOut(ModelWithJSONEncoder):
+    timestamp: int # of the snapshot the tickers come from
+    trades: Dict[str, PairTradesModel]
+
+class BulkTradesOut(ModelWithJSONEncoder):
+    chains: Dict[str, ChainTradesOut] = {}
@@ -1,20 +1,80 @@
-from fastapi import APIRouter, Security, Query
+from fastapi import APIRouter, Request, Security, Query
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from starlette.concurrency import run_in_threadpool
+
+from asyncio import ensure_future
+from typing import List, Optional
 
 from .web import BobVaults
 from .misc import verify_chain
-from .models import BobVaultDataModel, ListOfPairsOut, ListOfTickersOut, OrderbookOut, PairTradesModel
+from .models import BobVaultDataModel, ListOfPairsOut, ListOfTickersOut, OrderbookOut, PairTradesModel, \
+    BulkOrderbooksOut, BulkTradesOut
 
 from utils.misc import check_auth_token, MINTIMESTAMP, MAXTIMESTAMP, execute_request_with_time_measurement
 from utils.logging import info, warning
 from utils.models import UploadResponse
+from utils.executor import BoundedExecutor, parse_body
+from utils.compression import read_body, compressed_response
+from utils.settings import Settings
+
+_settings = Settings.get()
 
 _security = HTTPBearer()
 
 router = APIRouter()
 
+def _split(value: str) -> Optional[List[str]]:
+    # `*` stands for everything, otherwise a comma separated list
+    if value.strip() == '*':
+        return None
+    return [v.strip() for v in value.split(',') if v.strip() != '']
+
+def _bulk_chains(chains: str) -> List[str]:
+    selected = _split(chains)
+    if selected is None:
+        return list(_settings.bobvault_chains)
+    return [c for c in selected if verify_chain(c)]
+
+@router.get("/bulk/orderbooks", response_model=BulkOrderbooksOut)
+async def bobvault_bulk_orderbooks(request: Request,
+                                   chains: str = '*',
+                                   ticker_ids: str = '*',
+                                   depth: int = Query(0, ge=0)) -> BulkOrderbooksOut:
+    executor = BoundedExecutor()
+    output = await executor.run(
+        execute_request_with_time_measurement,
+        BobVaults().bulk_orderbooks,
+        _bulk_chains(chains),
+        _split(ticker_ids),
+        depth
+    )
+    return await executor.run(compressed_response, request, output)
+
+@router.get("/bulk/historical_trades", response_model=BulkTradesOut, response_model_exclude_none=True)
+async def bobvault_bulk_historical_trades(request: Request,
+                                          chains: str = '*',
+                                          ticker_ids: str = '*',
+                                          type: Optional[str] = Query(None, regex=r"^sell$|^buy$"),
+                                          # Bounded, all trades of all vaults would make a huge response
+                                          limit: int = Query(_settings.bulk_trades_default_limit,
+                                                             ge=1, le=_settings.bulk_trades_max_limit),
+                                          start_time: int = MINTIMESTAMP,
+                                          end_time: int = MAXTIMESTAMP) -> BulkTradesOut:
+    executor = BoundedExecutor()
+    output = await executor.run(
+        execute_request_with_time_measurement,
+        BobVaults().bulk_trades,
+        _bulk_chains(chains),
+        _split(ticker_ids),
+        [type] if type is not None else ['buy', 'sell'],
+        limit,
+        start_time,
+        end_time
+    )
+    return await executor.run(compressed_response, request, output, exclude_none=True)
+
 @router.post("/{chain}/upload", response_model = UploadResponse)
-async def upload(chain: str, data: BobVaultDataModel,
+async def upload(chain: str, request: Request,
                  credentials: HTTPAuthorizationCredentials = Security(_security)) -> UploadResponse:
     if not check_auth_token(credentials.credentials):
         return UploadResponse(status="Incorrect auth token")
@@ -22,33 +82,59 @@ async def upload(chain: str, data: BobVaultDataModel,
     if not verify_chain(chain):
         return UploadResponse(status="Incorrect chain")
 
-    execute_request_with_time_measurement(BobVaults().store, chain, data)
+    # The body is parsed in the pool rather than by FastAPI in the event loop
+    executor = BoundedExecutor()
+    body = await read_body(request)
+    data = await executor.run(
+        parse_body,
+        BobVaultDataModel,
+        body,
+        request.headers.get('content-encoding'),
+        timeout=_settings.executor_upload_timeout
+    )
+    await executor.run(
+        execute_request_with_time_measurement,
+        BobVaults().store,
+        chain,
+        data,
+        timeout=_settings.executor_upload_timeout
+    )
 
     return UploadResponse(status="success")
 
 @router.get("/{chain}/pairs", response_model = ListOfPairsOut)
-async def bobvault_pairs(chain: str) -> ListOfPairsOut:
+async def bobvault_pairs(chain: str, request: Request) -> ListOfPairsOut:
     if not verify_chain(chain):
         return ListOfPairsOut()
 
-    return execute_request_with_time_measurement(BobVaults().pairs, chain)
+    encoded = await BoundedExecutor().run(execute_request_with_time_measurement, BobVaults().encoded, chain, 'pairs')
+    return encoded.response(request)
 
 @router.get("/{chain}/tickers", response_model = ListOfTickersOut)
-async def bobvault_tickers(chain: str) -> ListOfTickersOut:
+async def bobvault_tickers(chain: str, request: Request) -> ListOfTickersOut:
     if not verify_chain(chain):
         return ListOfTickersOut()
 
-    return execute_request_with_time_measurement(BobVaults().tickers, chain)
+    encoded = await BoundedExecutor().run(execute_request_with_time_measurement, BobVaults().encoded, chain, 'tickers')
+    return encoded.response(request)
 
 @router.get("/{chain}/orderbook", response_model=OrderbookOut, response_model_exclude_unset=True)
-async def bobvault_orderbook(chain: str, ticker_id: str, depth: int = 0) -> OrderbookOut:
+async def bobvault_orderbook(chain: str, ticker_id: str, request: Request, depth: int = 0) -> OrderbookOut:
     if not verify_chain(chain):
         return OrderbookOut()
 
-    return execute_request_with_time_measurement(BobVaults().orderbook, chain, ticker_id)
+    encoded = await BoundedExecutor().run(
+        execute_request_with_time_measurement,
+        BobVaults().encoded,
+        chain,
+        'orderbook',
+        ticker_id
+    )
+    return encoded.response(request)
 
 @router.get("/{chain}/historical_trades", response_model=PairTradesModel, response_model_exclude_none=True)
 async def bobvault_historical_trades(chain: str,
+                                     request: Request,
                                      ticker_id: str, 
                                      type: str = Query(regex=r"^sell$|^buy$"),
                                      limit: int = 0,
@@ -57,7 +143,9 @@ async def bobvault_historical_trades(chain: str,
     if not verify_chain(chain):
         return PairTradesModel()
 
-    return execute_request_with_time_measurement(
+    executor = BoundedExecutor()
+    output = await executor.run(
+        execute_request_with_time_measurement,
         BobVaults().historical_trades,
         chain,
         ticker_id,
@@ -66,7 +154,10 @@ async def bobvault_historical_trades(chain: str,
         start_time,
         end_time
     )
+    return await executor.run(compressed_response, request, output, exclude_none=True)
 
 @router.on_event("startup")
 async def startup_event():
-    BobVaults()
+    # Only the data timestamps are read here, the data itself
+    # is loaded in background to open the port sooner
+    ensure_future(run_in_threadpool(BobVaults().warm_up))
@@ -0,0 +1,92 @@
+from typing import Dict, List, NamedTuple, Optional
+from decimal import Decimal
+
+from .models import BobVaultDataModel, BobVaultTradeModel
+
+from utils.misc import MINTIMESTAMP, MAXTIMESTAMP
+
+# Lightweight immutable containers for the vault data accepted by the service.
+# The data is validated once by BobVaultDataModel (on upload or on snapshot
+# load) and then kept in these structures, so the read handlers do not need
+# to walk through nested pydantic models again.
+
+class Trade(NamedTuple):
+    trade_id: int
+    price: Decimal
+    base_volume: Decimal
+    target_volume: Decimal
+    trade_timestamp: Decimal # in fact, this is str(int)
+    type: str
+
+    @classmethod
+    def from_model(cls, model: BobVaultTradeModel) -> 'Trade':
+        return cls(
+            model.trade_id,
+            model.price,
+            model.base_volume,
+            model.target_volume,
+            model.trade_timestamp,
+            model.type
+        )
+
+class Orderbook(NamedTuple):
+    bids: List[List[Decimal]]
+    asks: List[List[Decimal]]
+
+class Ticker(NamedTuple):
+    pool_id: str
+    base_currency: str
+    target_currency: str
+    last_price: Decimal
+    base_volume: Decimal
+    target_volume: Decimal
+    bid: Decimal
+    ask: Decimal
+    high: Decimal
+    low: Decimal
+
+class Pair(NamedTuple):
+    ticker: Ticker
+    timestamp: Decimal # in fact, this is str(int)
+    orderbook: Orderbook
+    buy: Optional[List[Trade]]
+    sell: Optional[List[Trade]]
+
+    def trades(self, type: str) -> Optional[List[Trade]]:
+        return getattr(self, type, None)
+
+def _trades(trades: Optional[List[BobVaultTradeModel]]) -> Optional[List[Trade]]:
+    if trades is None:
+        return None
+    return [Trade.from_model(t) for t in trades]
+
+class VaultSnapshot(NamedTuple):
+    timestamp: int
+    pairs: Dict[str, Pair]
+
+    @classmethod
+    def from_model(cls, data: BobVaultDataModel, with_trades: bool = True) -> 'VaultSnapshot':
+        pairs = {}
+        for ticker_id in data.pairs():
+            pair = data[ticker_id]
+            pairs[ticker_id] = Pair(
+                ticker = Ticker(**{f: getattr(pair, f) for f in Ticker._fields}),
+                timestamp = pair.timestamp,
+                orderbook = Orderbook(pair.orderbook.bids, pair.orderbook.asks),
+                buy = _trades(pair.trades.buy) if with_trades else None,
+                sell = _trades(pair.trades.sell) if with_trades else None
+            )
+        return cls(data['timestamp'], pairs)
+
+def select_trades(trades: List[Trade], limit: int, start_time: int, end_time: int) -> List[Trade]:
+    if limit == 0 and start_time == MINTIMESTAMP and end_time == MAXTIMESTAMP:
+        return trades
+    elif limit != 0 and start_time == MINTIMESTAMP and end_time == MAXTIMESTAMP:
+        return trades[-limit:]
+    selected = []
+    for trade in trades:
+        if trade.trade_timestamp >= start_time and trade.trade_timestamp <= end_time:
+            selected.append(trade)
+            if len(selected) == limit:
+                break
+    return selected
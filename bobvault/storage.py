@@ -0,0 +1,336 @@
+from abc import ABC, abstractmethod
+from functools import cache
+from typing import Callable, Dict, Hashable, List, Optional
+from decimal import Decimal
+from json import dumps, loads
+import re
+
+import sqlite3
+
+from pydantic import ValidationError
+
+from .models import BobVaultDataModel
+from .snapshot import VaultSnapshot, Pair, Ticker, Orderbook, Trade, select_trades
+
+from utils.logging import info, warning, error
+from utils.misc import CustomJSONEncoder, MINTIMESTAMP, MAXTIMESTAMP
+from utils.settings import Settings
+from utils.shared import atomic_dump, load_json, file_stamp
+from utils.storage import SQLiteDatabase, sqlite_database
+
+# The timestamp written as the first key of a JSON snapshot
+_TIMESTAMP_PREFIX = re.compile(rb'\s*\{\s*"timestamp"\s*:\s*(\d+)\s*[,}]')
+_TIMESTAMP_PREFIX_SIZE = 256
+
+class VaultStorage(ABC):
+    """Persists vault data uploaded for every chain"""
+    # Everything is served from the snapshot kept in memory, so saving can be deferred
+    serves_from_memory: bool = True
+
+    @abstractmethod
+    def save(self, chain: str, data: BobVaultDataModel) -> None:
+        ...
+
+    @abstractmethod
+    def load(self, chain: str) -> VaultSnapshot:
+        """Raises IOError if nothing was stored for the chain"""
+
+    @abstractmethod
+    def timestamp(self, chain: str) -> int:
+        """The timestamp of stored data without loading it, raises IOError if nothing stored"""
+
+    def snapshot(self, data: BobVaultDataModel) -> VaultSnapshot:
+        """The in-memory representation of just saved data"""
+        return VaultSnapshot.from_model(data)
+
+    @abstractmethod
+    def trades(self, chain: str,
+                     snapshot: VaultSnapshot,
+                     ticker_id: str,
+                     type: str,
+                     limit: int,
+                     start_time: int,
+                     end_time: int) -> Optional[List[Trade]]:
+        ...
+
+    def trades_many(self, chain: str,
+                          snapshot: VaultSnapshot,
+                          ticker_ids: List[str],
+                          types: List[str],
+                          limit: int,
+                          start_time: int,
+                          end_time: int) -> Dict[str, Dict[str, Optional[List[Trade]]]]:
+        """Trades of several tickers by ticker_id and type, all from the same state of the storage"""
+        return {
+            ticker_id: {
+                type: self.trades(chain, snapshot, ticker_id, type, limit, start_time, end_time) for type in types
+            } for ticker_id in ticker_ids
+        }
+
+    @abstractmethod
+    def version(self, chain: str) -> Hashable:
+        """Changes every time data for the chain is saved"""
+
+    @abstractmethod
+    def source(self, chain: str) -> str:
+        """The file to watch for changes of the chain data"""
+
+class JSONVaultStorage(VaultStorage):
+    """Whole snapshot per chain in a JSON file, trades are kept in memory"""
+
+    def source(self, chain: str) -> str:
+        settings = Settings.get()
+        return f'{settings.snapshot_dir}/' + \
+               settings.coingecko_snapshot_file_template.format(chain=chain)
+
+    def save(self, chain: str, data: BobVaultDataModel) -> None:
+        # The timestamp goes first to be read at start without parsing the whole snapshot
+        data = data.dict()
+        atomic_dump(self.source(chain), {'timestamp': data.pop('timestamp'), **data})
+
+    def load(self, chain: str) -> VaultSnapshot:
+        filename = self.source(chain)
+        try:
+            with open(filename, 'r') as json_file:
+                data = ''.join(json_file.readlines())
+                data = BobVaultDataModel.parse_raw(data)
+        except IOError as e:
+            warning(f'No snapshot {filename} found')
+            raise e
+        except ValidationError as e:
+            error(f'Cannot parse snapshot data')
+            raise e
+        return VaultSnapshot.from_model(data)
+
+    def timestamp(self, chain: str) -> int:
+        filename = self.source(chain)
+        with open(filename, 'rb') as json_file:
+            match = _TIMESTAMP_PREFIX.match(json_file.read(_TIMESTAMP_PREFIX_SIZE))
+        if match:
+            return int(match.group(1))
+        # Snapshots saved with the timestamp elsewhere
+        return load_json(filename)['timestamp']
+
+    def trades(self, chain: str,
+                     snapshot: VaultSnapshot,
+                     ticker_id: str,
+                     type: str,
+                     limit: int,
+                     start_time: int,
+                     end_time: int) -> Optional[List[Trade]]:
+        tmp = snapshot.pairs[ticker_id].trades(type)
+        if not tmp:
+            return None
+        return select_trades(tmp, limit, start_time, end_time)
+
+    def version(self, chain: str) -> Hashable:
+        return file_stamp(self.source(chain))
+
+_TICKER_DECIMALS = [f for f, t in Ticker.__annotations__.items() if t is Decimal]
+
+def _decimals(rows: List[List[str]]) -> List[List[Decimal]]:
+    return [[Decimal(v) for v in row] for row in rows]
+
+class SQLiteVaultStorage(VaultStorage):
+    """Tickers and orderbooks per upload, trades in one indexed table
+
+    Trades from every upload are merged into the table, so the trade history
+    is retained even if the feeder sends only recent trades, and historical
+    trades are served by range queries instead of being kept in memory.
+    """
+    serves_from_memory = False
+
+    def __init__(self, db: SQLiteDatabase):
+        self.db = db
+        with self.db.transaction() as c:
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS vault_uploads (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chain TEXT NOT NULL,
+                    timestamp INTEGER NOT NULL
+                )
+            ''')
+            c.execute('CREATE INDEX IF NOT EXISTS vault_uploads_chain ON vault_uploads (chain, id)')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS vault_tickers (
+                    upload_id INTEGER NOT NULL,
+                    ticker_id TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    ticker TEXT NOT NULL,
+                    orderbook TEXT NOT NULL,
+                    PRIMARY KEY (upload_id, ticker_id)
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS vault_trades (
+                    chain TEXT NOT NULL,
+                    ticker_id TEXT NOT NULL,
+                    side TEXT NOT NULL,
+                    trade_timestamp INTEGER NOT NULL,
+                    trade_id INTEGER NOT NULL,
+                    price TEXT NOT NULL,
+                    base_volume TEXT NOT NULL,
+                    target_volume TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    PRIMARY KEY (chain, ticker_id, side, trade_timestamp, trade_id)
+                ) WITHOUT ROWID
+            ''')
+
+    def source(self, chain: str) -> str:
+        return self.db.filename
+
+    def snapshot(self, data: BobVaultDataModel) -> VaultSnapshot:
+        return VaultSnapshot.from_model(data, with_trades=False)
+
+    def save(self, chain: str, data: BobVaultDataModel) -> None:
+        retention = Settings.get().sqlite_uploads_retention
+        with self.db.transaction() as c:
+            upload_id = c.execute(
+                'INSERT INTO vault_uploads (chain, timestamp) VALUES (?, ?)',
+                (chain, data['timestamp'])
+            ).lastrowid
+            new_trades = 0
+            for ticker_id in data.pairs():
+                pair = data[ticker_id]
+                ticker = {f: getattr(pair, f) for f in Ticker._fields}
+                c.execute(
+                    'INSERT INTO vault_tickers VALUES (?, ?, ?, ?, ?)',
+                    (
+                        upload_id,
+                        ticker_id,
+                        str(pair.timestamp),
+                        dumps(ticker, cls=CustomJSONEncoder),
+                        dumps(pair.orderbook.dict(), cls=CustomJSONEncoder)
+                    )
+                )
+                for side in ['buy', 'sell']:
+                    for t in getattr(pair.trades, side) or []:
+                        new_trades += c.execute(
+                            'INSERT OR IGNORE INTO vault_trades VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (
+                                chain,
+                                ticker_id,
+                                side,
+                                int(t.trade_timestamp),
+                                t.trade_id,
+                                str(t.price),
+                                str(t.base_volume),
+                                str(t.target_volume),
+                                t.type
+                            )
+                        ).rowcount
+            if retention > 0:
+                # Tickers and orderbooks are kept for the latest uploads only
+                expired = '''
+                    SELECT id FROM vault_uploads WHERE chain = ? AND id NOT IN (
+                        SELECT id FROM vault_uploads WHERE chain = ? ORDER BY id DESC LIMIT ?
+                    )
+                '''
+                c.execute(f'DELETE FROM vault_tickers WHERE upload_id IN ({expired})', (chain, chain, retention))
+                c.execute(f'DELETE FROM vault_uploads WHERE id IN ({expired})', (chain, chain, retention))
+        info(f'{new_trades} new trades for {chain} stored in {self.db.filename}')
+
+    def load(self, chain: str) -> VaultSnapshot:
+        try:
+            uploads = self.db.execute(
+                'SELECT id, timestamp FROM vault_uploads WHERE chain = ? ORDER BY id DESC LIMIT 1',
+                (chain,)
+            )
+            if len(uploads) == 0:
+                raise IOError(f'No data for {chain} in {self.db.filename}')
+            upload_id, timestamp = uploads[0]
+            rows = self.db.execute(
+                'SELECT ticker_id, timestamp, ticker, orderbook FROM vault_tickers WHERE upload_id = ?',
+                (upload_id,)
+            )
+        except sqlite3.Error as e:
+            error(f'Cannot read {chain} data from {self.db.filename}')
+            raise IOError(e)
+
+        pairs = {}
+        for ticker_id, pair_ts, ticker, orderbook in rows:
+            ticker = loads(ticker)
+            for f in _TICKER_DECIMALS:
+                ticker[f] = Decimal(ticker[f])
+            orderbook = loads(orderbook)
+            pairs[ticker_id] = Pair(
+                ticker = Ticker(**ticker),
+                timestamp = Decimal(pair_ts),
+                orderbook = Orderbook(_decimals(orderbook['bids']), _decimals(orderbook['asks'])),
+                buy = None,
+                sell = None
+            )
+        return VaultSnapshot(timestamp, pairs)
+
+    def timestamp(self, chain: str) -> int:
+        rows = self.db.execute(
+            'SELECT timestamp FROM vault_uploads WHERE chain = ? ORDER BY id DESC LIMIT 1',
+            (chain,)
+        )
+        if len(rows) == 0:
+            raise IOError(f'No data for {chain} in {self.db.filename}')
+        return rows[0][0]
+
+    def trades(self, chain: str,
+                     snapshot: VaultSnapshot,
+                     ticker_id: str,
+                     type: str,
+                     limit: int,
+                     start_time: int,
+                     end_time: int) -> Optional[List[Trade]]:
+        return self._trades(self.db.execute, chain, ticker_id, type, limit, start_time, end_time)
+
+    def trades_many(self, chain: str,
+                          snapshot: VaultSnapshot,
+                          ticker_ids: List[str],
+                          types: List[str],
+                          limit: int,
+                          start_time: int,
+                          end_time: int) -> Dict[str, Dict[str, Optional[List[Trade]]]]:
+        # One read transaction, so an upload committed in between is seen by all queries or by none
+        with self.db.transaction('DEFERRED') as c:
+            execute = lambda query, parameters: c.execute(query, parameters).fetchall()
+            return {
+                ticker_id: {
+                    type: self._trades(execute, chain, ticker_id, type, limit, start_time, end_time)
+                    for type in types
+                } for ticker_id in ticker_ids
+            }
+
+    def _trades(self, execute: Callable[[str, list], list],
+                      chain: str,
+                      ticker_id: str,
+                      type: str,
+                      limit: int,
+                      start_time: int,
+                      end_time: int) -> List[Trade]:
+        query = '''
+            SELECT trade_id, price, base_volume, target_volume, trade_timestamp, type
+            FROM vault_trades
+            WHERE chain = ? AND ticker_id = ? AND side = ? AND trade_timestamp BETWEEN ? AND ?
+        '''
+        parameters = [chain, ticker_id, type, start_time, end_time]
+        newest_first = limit != 0 and start_time == MINTIMESTAMP and end_time == MAXTIMESTAMP
+        if newest_first:
+            query += ' ORDER BY trade_timestamp DESC, trade_id DESC LIMIT ?'
+        else:
+            query += ' ORDER BY trade_timestamp, trade_id LIMIT ?'
+        parameters.append(limit if limit != 0 else -1)
+
+        rows = execute(query, parameters)
+        if newest_first:
+            rows.reverse()
+        return [
+            Trade(trade_id, Decimal(price), Decimal(base_volume), Decimal(target_volume), Decimal(ts), t)
+            for trade_id, price, base_volume, target_volume, ts, t in rows
+        ]
+
+    def version(self, chain: str) -> Hashable:
+        rows = self.db.execute('SELECT MAX(id) FROM vault_uploads WHERE chain = ?', (chain,))
+        return rows[0][0]
+
+@cache
+def vault_storage() -> VaultStorage:
+    if Settings.get().storage_backend == 'sqlite':
+        return SQLiteVaultStorage(sqlite_database())
+    return JSONVaultStorage()
@@ -1,45 +1,111 @@
 from functools import cache
-from typing import Dict
-from json import dump
-
-from pydantic import ValidationError
+from typing import Dict, Hashable, List, NamedTuple, Optional
+from threading import Lock, RLock
 
 from .models import BobVaultDataModel, ListOfPairsOut, PairOutDataModel, \
-    TickerBaseModel, TickerOutDataModel, ListOfTickersOut, PairOrderbookModel, \
-    OrderbookOut, PairTradesModel
+    TickerOutDataModel, ListOfTickersOut, OrderbookOut, PairTradesModel, \
+    BobVaultTradeModel, ChainOrderbooksOut, BulkOrderbooksOut, ChainTradesOut, BulkTradesOut
+from .snapshot import VaultSnapshot
+from .storage import VaultStorage, vault_storage
 
-from utils.logging import info, warning, error
+from utils.logging import info, warning
 from utils.health import Health, HealthRegistry, WorkerHealthModelOut
 from utils.settings import Settings
-from utils.misc import CustomJSONEncoder, MINTIMESTAMP, MAXTIMESTAMP, Named
+from utils.misc import MINTIMESTAMP, MAXTIMESTAMP, Named
+from utils.watcher import SnapshotWatcher
+from utils.persistence import WriteBehind
+from utils.profiling import Profiler
+from utils.compression import EncodedBody, render
 
 _settings = Settings.get()
 
+# Reads served from the snapshot only, with the response_model_* options of their routes
+_ENCODED_READS = {
+    'pairs': {},
+    'tickers': {},
+    'orderbook': {'exclude_unset': True}
+}
+
+class EncodedCache(NamedTuple):
+    snapshot: Optional[VaultSnapshot]
+    bodies: Dict[tuple, EncodedBody]
+
 class BobVault(Health):
+    _snapshot: Optional[VaultSnapshot]
+    _seen_version: Hashable
+    _encoded: EncodedCache
 
-    def __init__(self, chain: str):
-        self.filename = f'{_settings.snapshot_dir}/' + \
-                        _settings.coingecko_snapshot_file_template.format(chain=chain)
+    def __init__(self, chain: str, storage: VaultStorage):
+        self.chain = chain
+        self._storage = storage
         info(f'Checking for available bobvault data for {chain}')
         self._name = f'{type(self).__name__}/{chain}'
+        self.topic = f'vault:{chain}'
+        self._snapshot = None
+        self._seen_version = None
+        self._encoded = EncodedCache(None, {})
+        self._loaded = False
+        self._load_lock = Lock()
+        # Uploads stored and written to the storage so far, a reload never replaces newer uploads
+        self._swap_lock = RLock()
+        self._generation = 0
+        self._saved_generation = 0
         self.initialize_healthdata()
+        SnapshotWatcher().watch(self._storage.source(chain), self)
+        Profiler().register_load_path(self.name(), lambda: self._storage.load(self.chain))
+
+    def _load_timestamp(self) -> int:
+        return self._storage.timestamp(self.chain)
+
+    def _load(self) -> Optional[VaultSnapshot]:
+        """None if an upload stored in memory is newer than the data in the storage"""
+        self._loaded = True
+        generation = self._generation
+        if generation != self._saved_generation:
+            return None
+        version = self._storage.version(self.chain)
+        snapshot = self._storage.load(self.chain)
+        with self._swap_lock:
+            if generation != self._generation:
+                info(f'Data for {self.name()} was uploaded while loading, the loaded data is dropped')
+                return None
+            self._seen_version = version
+            self._snapshot = snapshot
+        return snapshot
+
+    def warm_up(self):
+        with self._load_lock:
+            if self._loaded:
+                return
+            info(f'Loading data for {self.name()}')
+            try:
+                self._load()
+            except:
+                pass
 
-    def _dump(self, data: BobVaultDataModel):
-        with open(self.filename, 'w') as json_file:
-            dump(data.dict(), json_file, cls=CustomJSONEncoder)
+    def _current(self) -> Optional[VaultSnapshot]:
+        # The data is loaded by the warm-up task, a request arriving earlier loads it itself
+        if not self._loaded:
+            self.warm_up()
+        return self._snapshot
 
-    def _load(self) -> BobVaultDataModel:
+    def sync(self):
+        # The data could be replaced by another worker or replica
+        if not self._loaded or self._storage.version(self.chain) == self._seen_version:
+            return
+        info(f'Data for {self.name()} changed, reloading')
         try:
-            with open(self.filename, 'r') as json_file:
-                data = ''.join(json_file.readlines())
-                data = BobVaultDataModel.parse_raw(data)
-            return data
-        except IOError as e:
-            warning(f'No snapshot {self.filename} found')
-            raise e
-        except ValidationError as e:
-            error(f'Cannot parse snapshot data')
-            raise e
+            data = self._load()
+        except:
+            return
+        if data is not None:
+            self.record_sucess(data.timestamp)
+
+    def _save(self, data: BobVaultDataModel, generation: int):
+        self._storage.save(self.chain, data)
+        with self._swap_lock:
+            self._seen_version = self._storage.version(self.chain)
+            self._saved_generation = max(self._saved_generation, generation)
 
     def store(self, data: BobVaultDataModel):
         data_ts = data["timestamp"]
@@ -50,61 +116,75 @@ class BobVault(Health):
         else:
             warning(f'No pairs found in data stamped as {data_ts}')
 
-        self._dump(data)
-        
+        snapshot = self._storage.snapshot(data)
+        with self._swap_lock:
+            self._generation += 1
+            generation = self._generation
+            if not self._storage.serves_from_memory:
+                # Trades are read from the storage, the new tickers are not served before them
+                self._save(data, generation)
+            self._snapshot = snapshot
+            self._loaded = True
+        if self._storage.serves_from_memory:
+            # The data is served from memory right away and written to the storage in background
+            WriteBehind().submit((type(self).__name__, self.chain), self._save, data, generation)
+
         self.record_sucess(data_ts)
 
     def pairs(self) -> ListOfPairsOut:
         info(f'Request to get pairs for {self.name()} received')
-        ret = ListOfPairsOut()
-        try:
-            data=self._load()
-        except:
-            return ret
-        
-        pairs = data.pairs()
-        for pair in pairs:
-            ret.append(PairOutDataModel(
-                ticker_id = pair,
-                base = data[pair].base_currency,
-                target = data[pair].target_currency,
-                pool_id = data[pair].pool_id
-            ))
-        return ret
+        data = self._current()
+        if data is None:
+            return ListOfPairsOut()
+
+        return ListOfPairsOut.construct(__root__ = [
+            PairOutDataModel.construct(
+                ticker_id = ticker_id,
+                base = pair.ticker.base_currency,
+                target = pair.ticker.target_currency,
+                pool_id = pair.ticker.pool_id
+            ) for ticker_id, pair in data.pairs.items()
+        ])
 
     def tickers(self) -> ListOfTickersOut:
         info(f'Request to get tickers for {self.name()} received')
-        ret = ListOfTickersOut()
-        try:
-            data=self._load()
-        except:
-            return ret
-        
-        pairs = data.pairs()
-        for pair in pairs:
-            ticker = TickerBaseModel.parse_obj(data[pair]).dict()
-            ticker.update({
-                'ticker_id': pair
-            })
-            ret.append(TickerOutDataModel.parse_obj(ticker))
-        return ret
+        data = self._current()
+        if data is None:
+            return ListOfTickersOut()
+
+        return ListOfTickersOut.construct(__root__ = [
+            TickerOutDataModel.construct(ticker_id = ticker_id, **pair.ticker._asdict())
+            for ticker_id, pair in data.pairs.items()
+        ])
 
     def orderbook(self, ticker_id: str) -> OrderbookOut:
         info(f'Request to get orderbook for {ticker_id} in {self.name()} received')
-        try:
-            data=self._load()
-        except:
+        data = self._current()
+        if data is None or not ticker_id in data.pairs:
             return OrderbookOut()
 
-        if not ticker_id in data.pairs():
-            return OrderbookOut()
-        
-        ob = PairOrderbookModel.parse_obj(data[ticker_id].orderbook).dict()
-        ob.update({
-            'ticker_id': ticker_id,
-            'timestamp': data[ticker_id].timestamp
-        })
-        return OrderbookOut.parse_obj(ob)
+        pair = data.pairs[ticker_id]
+        return OrderbookOut.construct(
+            bids = pair.orderbook.bids,
+            asks = pair.orderbook.asks,
+            ticker_id = ticker_id,
+            timestamp = pair.timestamp
+        )
+
+    def encoded(self, read: str, *args) -> EncodedBody:
+        """The rendered and compressed output of a read, computed once per snapshot"""
+        data = self._current()
+        cached = self._encoded
+        if cached.snapshot is not data:
+            cached = self._encoded = EncodedCache(data, {})
+        key = (read, *args)
+        body = cached.bodies.get(key)
+        if body is None:
+            body = EncodedBody.encode(render(getattr(self, read)(*args), **_ENCODED_READS[read]))
+            # Unknown tickers are not kept, otherwise the cache could grow without limit
+            if data is not None and (read != 'orderbook' or args[0] in data.pairs):
+                cached.bodies[key] = body
+        return body
 
     def historical_trades(self, ticker_id: str, 
                                 type: str,
@@ -112,45 +192,87 @@ class BobVault(Health):
                                 start_time: int, 
                                 end_time: int) -> PairTradesModel:
         info(f'Request to get {type} trades for {ticker_id} in {self.name()} received')
-        try:
-            data=self._load()
-        except:
+        data = self._current()
+        if data is None:
             return PairTradesModel()
 
-        if not ticker_id in data.pairs():
+        if not ticker_id in data.pairs:
             warning(f'Ticker {ticker_id} not found')
             return PairTradesModel()
 
-        tmp = getattr(data[ticker_id].trades, type, None)
-        if not tmp:
+        selected = self._storage.trades(self.chain, data, ticker_id, type, limit, start_time, end_time)
+        if selected is None or (len(selected) == 0 and limit == 0 and \
+                                start_time == MINTIMESTAMP and end_time == MAXTIMESTAMP):
             info(f'no trades for "{type}" found')
             return PairTradesModel()
-        else:
-            if limit == 0 and start_time == MINTIMESTAMP and end_time == MAXTIMESTAMP:
-                response = { type: tmp }
-            elif limit != 0 and start_time == MINTIMESTAMP and end_time == MAXTIMESTAMP:
-                response = { type: tmp[-limit:] }
-            else:
-                response = { type: [] }
-                count = 0
-                for trade in tmp:
-                    if trade.trade_timestamp >= start_time and trade.trade_timestamp <= end_time:
-                        response[type].append(trade.dict())
-                        count += 1
-                        if count == limit:
-                            break
-            return PairTradesModel.parse_obj(response)
+
+        return PairTradesModel.construct(**{
+            type: [BobVaultTradeModel.construct(**t._asdict()) for t in selected]
+        })
+
+    # Bulk reads take every ticker from one snapshot, `None` for ticker_ids means all of them
+
+    def bulk_orderbooks(self, ticker_ids: Optional[List[str]], depth: int) -> Optional[ChainOrderbooksOut]:
+        data = self._current()
+        if data is None:
+            return None
+
+        # As in the CoinGecko API: depth 100 means 50 bids and 50 asks, 0 means all of them.
+        # At least one level per side is returned for any other depth
+        side = max(1, depth // 2) if depth > 0 else None
+        orderbooks = {}
+        for ticker_id in _selected(data, ticker_ids):
+            pair = data.pairs[ticker_id]
+            orderbooks[ticker_id] = OrderbookOut.construct(
+                bids = pair.orderbook.bids[:side],
+                asks = pair.orderbook.asks[:side],
+                ticker_id = ticker_id,
+                timestamp = pair.timestamp
+            )
+        return ChainOrderbooksOut.construct(timestamp=data.timestamp, orderbooks=orderbooks)
+
+    def bulk_trades(self, ticker_ids: Optional[List[str]],
+                          types: List[str],
+                          limit: int,
+                          start_time: int,
+                          end_time: int) -> Optional[ChainTradesOut]:
+        data = self._current()
+        if data is None:
+            return None
+
+        unfiltered = limit == 0 and start_time == MINTIMESTAMP and end_time == MAXTIMESTAMP
+        selected = self._storage.trades_many(
+            self.chain, data, _selected(data, ticker_ids), types, limit, start_time, end_time
+        )
+        trades = {}
+        for ticker_id, by_type in selected.items():
+            # The same as historical_trades() returns for every type
+            trades[ticker_id] = PairTradesModel.construct(**{
+                type: [BobVaultTradeModel.construct(**t._asdict()) for t in ts]
+                for type, ts in by_type.items() if ts is not None and (len(ts) > 0 or not unfiltered)
+            })
+        return ChainTradesOut.construct(timestamp=data.timestamp, trades=trades)
+
+def _selected(data: VaultSnapshot, ticker_ids: Optional[List[str]]) -> List[str]:
+    if ticker_ids is None:
+        return list(data.pairs)
+    return [t for t in ticker_ids if t in data.pairs]
 
 @cache
 class BobVaults(Named):
 
     def __init__(self):
         self.vaults = {}
+        storage = vault_storage()
         for c in _settings.bobvault_chains:
-            self.vaults[c] = BobVault(c)
+            self.vaults[c] = BobVault(c, storage)
 
         HealthRegistry().append(self)
 
+    def warm_up(self):
+        for c in self.vaults:
+            self.vaults[c].warm_up()
+
     def healthdata_for_publishing(self, curtime: int) -> Dict[str, WorkerHealthModelOut]:
         ret = {}
         info(f'Preparing {self.name()} healthdata for publishing')
@@ -173,6 +295,9 @@ class BobVaults(Named):
     def orderbook(self, chain: str, ticker_id: str) -> OrderbookOut:
         return self.vaults[chain].orderbook(ticker_id)
 
+    def encoded(self, chain: str, read: str, *args) -> EncodedBody:
+        return self.vaults[chain].encoded(read, *args)
+
     def historical_trades(self, chain: str, 
                                 ticker_id: str, 
                                 type: str,
@@ -180,3 +305,26 @@ class BobVaults(Named):
                                 start_time: int, 
                                 end_time: int) -> PairTradesModel:
         return self.vaults[chain].historical_trades(ticker_id, type, limit, start_time, end_time)
+
+    def bulk_orderbooks(self, chains: List[str], ticker_ids: Optional[List[str]], depth: int) -> BulkOrderbooksOut:
+        info(f'Request to get orderbooks of {len(chains)} chains received')
+        out = {}
+        for c in chains:
+            chain_out = self.vaults[c].bulk_orderbooks(ticker_ids, depth)
+            if chain_out is not None:
+                out[c] = chain_out
+        return BulkOrderbooksOut.construct(chains=out)
+
+    def bulk_trades(self, chains: List[str],
+                          ticker_ids: Optional[List[str]],
+                          types: List[str],
+                          limit: int,
+                          start_time: int,
+                          end_time: int) -> BulkTradesOut:
+        info(f'Request to get trades of {len(chains)} chains received')
+        out = {}
+        for c in chains:
+            chain_out = self.vaults[c].bulk_trades(ticker_ids, types, limit, start_time, end_time)
+            if chain_out is not None:
+                out[c] = chain_out
+        return BulkTradesOut.construct(chains=out)
@@ -0,0 +1,89 @@
+from typing import AsyncIterator, List, Optional
+
+from asyncio import ensure_future
+from json import dumps
+
+from fastapi import APIRouter, HTTPException, WebSocket
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+
+from utils.events import Event, EventBroker, Subscription
+from utils.misc import CustomJSONEncoder
+from utils.settings import Settings
+
+_settings = Settings.get()
+
+router = APIRouter()
+
+def _topics(topics: str) -> Optional[List[str]]:
+    known = ['supply', 'bobstats'] + [f'vault:{c}' for c in _settings.bobvault_chains]
+    if topics.strip() == '*':
+        return known
+    selected = [t.strip() for t in topics.split(',') if t.strip() != '']
+    if len(selected) == 0 or any([not t in known for t in selected]):
+        return None
+    return selected
+
+def _message(event: Event) -> str:
+    return dumps({'id': event.id, 'topic': event.topic, 'data': event.data}, cls=CustomJSONEncoder)
+
+async def _unsubscribe(subscription: Subscription):
+    # A coroutine, so Starlette runs it in the event loop owning the subscriptions
+    # rather than in the threadpool as it does with plain functions
+    EventBroker().unsubscribe(subscription)
+
+async def _stream(subscription: Subscription) -> AsyncIterator[str]:
+    while True:
+        event = await subscription.get(_settings.events_keepalive)
+        if event is None:
+            # A comment keeps proxies from closing an idle connection
+            yield ': keepalive\n\n'
+        else:
+            yield f'id: {event.id}\nevent: {event.topic}\ndata: {event.json()}\n\n'
+
+@router.get("/")
+async def events_stream(topics: str = '*') -> StreamingResponse:
+    selected = _topics(topics)
+    if selected is None:
+        raise HTTPException(status_code=400, detail=f'Unknown topics {topics}')
+    broker = EventBroker()
+    if broker.is_full():
+        raise HTTPException(status_code=503, detail='Too many subscriptions',
+                            headers={'Retry-After': str(_settings.admission_retry_after)})
+
+    subscription = broker.subscribe(selected)
+    return StreamingResponse(
+        _stream(subscription),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        # Runs after the client disconnects
+        background=BackgroundTask(_unsubscribe, subscription)
+    )
+
+async def _send(websocket: WebSocket, subscription: Subscription):
+    while True:
+        event = await subscription.get(_settings.events_keepalive)
+        if event is not None:
+            await websocket.send_text(_message(event))
+
+@router.websocket("/ws")
+async def events_websocket(websocket: WebSocket, topics: str = '*'):
+    selected = _topics(topics)
+    broker = EventBroker()
+    if selected is None or broker.is_full():
+        # 1008 is a policy violation, 1013 asks to try again later
+        await websocket.close(code=1008 if selected is None else 1013)
+        return
+
+    await websocket.accept()
+    subscription = broker.subscribe(selected)
+    sender = ensure_future(_send(websocket, subscription))
+    try:
+        # Nothing is expected from the client, receiving only detects the disconnect
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+    finally:
+        sender.cancel()
+        broker.unsubscribe(subscription)
@@ -0,0 +1,56 @@
+from fastapi import APIRouter, HTTPException, Query, Security
+from fastapi.responses import PlainTextResponse, Response
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from starlette.concurrency import run_in_threadpool
+
+from utils.misc import check_auth_token
+from utils.profiling import Profiler, sample_stacks
+from utils.settings import Settings
+
+_settings = Settings.get()
+
+_security = HTTPBearer()
+
+router = APIRouter()
+
+def _authorize(credentials: HTTPAuthorizationCredentials):
+    if not check_auth_token(credentials.credentials):
+        raise HTTPException(status_code=403, detail='Incorrect auth token')
+
+@router.get("/sample", response_class=PlainTextResponse)
+async def sample(seconds: float = Query(10, gt=0),
+                 interval: float = Query(0.01, ge=0.001),
+                 credentials: HTTPAuthorizationCredentials = Security(_security)) -> str:
+    _authorize(credentials)
+    if seconds > _settings.profiling_max_seconds:
+        raise HTTPException(status_code=400, detail=f'No more than {_settings.profiling_max_seconds} seconds')
+
+    # One sampling at a time, several would only sample each other
+    profiler = Profiler()
+    if not profiler.sampling.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail='Sampling is already in progress')
+    try:
+        return await run_in_threadpool(sample_stacks, seconds, interval)
+    finally:
+        profiler.sampling.release()
+
+@router.get("/requests/{id}")
+async def request_profile(id: str,
+                          format: str = Query('text', regex=r"^text$|^pstats$"),
+                          limit: int = Query(50, gt=0),
+                          credentials: HTTPAuthorizationCredentials = Security(_security)) -> Response:
+    _authorize(credentials)
+    profile = Profiler().request(id)
+    if profile is None or profile.elapsed is None:
+        raise HTTPException(status_code=404, detail=f'No completed profile {id}')
+
+    if format == 'pstats':
+        return Response(content=profile.dump(), media_type='application/octet-stream',
+                        headers={'Content-Disposition': f'attachment; filename="{id}.pstats"'})
+    return PlainTextResponse(profile.text(limit))
+
+@router.get("/allocations", response_class=PlainTextResponse)
+async def allocations(limit: int = Query(10, gt=0),
+                      credentials: HTTPAuthorizationCredentials = Security(_security)) -> str:
+    _authorize(credentials)
+    return await run_in_threadpool(Profiler().allocations, limit)
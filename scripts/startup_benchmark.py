@@ -0,0 +1,53 @@
+"""Measures how long the service takes to start
+
+Reports the time to import the app module and the time from spawning
+`python app.py` until its port accepts connections. Run it from the
+repository root with the same environment the service is started with:
+
+    python scripts/startup_benchmark.py --runs 5 --port 8765
+"""
+
+from argparse import ArgumentParser
+from os import environ
+from socket import create_connection
+from statistics import mean, median
+from subprocess import DEVNULL, Popen, run
+from sys import executable
+from time import monotonic, sleep
+
+def import_time() -> float:
+    code = 'from time import monotonic; s = monotonic(); import app; print(monotonic() - s)'
+    result = run([executable, '-c', code], capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+def port_open_time(port: int, timeout: float) -> float:
+    env = dict(environ, PORT=str(port))
+    start = monotonic()
+    process = Popen([executable, 'app.py'], env=env, stdout=DEVNULL, stderr=DEVNULL)
+    try:
+        while monotonic() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f'app.py exited with code {process.returncode}')
+            try:
+                create_connection(('127.0.0.1', port), timeout=0.1).close()
+                return monotonic() - start
+            except OSError:
+                sleep(0.01)
+        raise TimeoutError(f'Port {port} is not open after {timeout} seconds')
+    finally:
+        process.terminate()
+        process.wait()
+
+def report(name: str, values: list):
+    print(f'{name}: min {min(values):.3f}s, median {median(values):.3f}s, '
+          f'mean {mean(values):.3f}s, max {max(values):.3f}s')
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measure the service start time')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    report('import app', [import_time() for _ in range(args.runs)])
+    report('port open', [port_open_time(args.port, args.timeout) for _ in range(args.runs)])
@@ -0,0 +1,141 @@
+from functools import cache
+from typing import Dict, Optional, Tuple
+from threading import Lock
+from decimal import Decimal
+from time import time
+
+from asyncio import gather
+from starlette.concurrency import run_in_threadpool
+
+from .models import ChainSupplyAtOut, TokenSupplyAtOut
+from .web import ChainSupply, TokenSupply
+
+from utils.logging import info, warning, error
+from utils.settings import Settings
+from utils.storage import document_storage
+
+_settings = Settings.get()
+
+class SupplyHistoryError(Exception):
+    pass
+
+@cache
+class SupplyHistory():
+    """totalSupply of tokens at past blocks and timestamps
+
+    The value at a finalized block, as well as the block found for a timestamp
+    if the next block is finalized, never changes. Both are appended to a
+    record log kept forever and served from there afterwards, so an archive RPC
+    is asked about every block once. Results near the chain head are not kept.
+    """
+    _values: Dict[Tuple[str, str, int], ChainSupplyAtOut]
+    _blocks: Dict[Tuple[str, str, int], int]
+
+    def __init__(self):
+        self.key = _settings.supply_history_file
+        self._storage = document_storage()
+        self._values = {}
+        self._blocks = {}
+        self._loaded = False
+        self._lock = Lock()
+
+    def _remember(self, record: dict):
+        if 'at' in record:
+            self._blocks[(record['token'], record['chain'], record['at'])] = record['block']
+        else:
+            self._values[(record['token'], record['chain'], record['block'])] = ChainSupplyAtOut(
+                block=record['block'],
+                timestamp=record['timestamp'],
+                value=Decimal(record['value']),
+                finalized=True
+            )
+
+    def _ensure_loaded(self):
+        # Loaded on the first request rather than on start
+        with self._lock:
+            if self._loaded:
+                return
+            records = self._storage.load_records(self.key)
+            info(f'{len(records)} records of historical supply loaded')
+            for r in records:
+                self._remember(r)
+            self._loaded = True
+
+    def _persist(self, record: dict):
+        self._remember(record)
+        try:
+            self._storage.append_record(self.key, record)
+        except IOError:
+            warning(f'Cannot store historical supply in {self.key}')
+
+    def _chain_at_block(self, chain: ChainSupply, block: int, latest: Optional[int]) -> ChainSupplyAtOut:
+        key = (chain.token, chain.chain, block)
+        cached = self._values.get(key)
+        if cached is not None:
+            return cached
+
+        if latest is None:
+            latest = chain.latest_block()
+        if block > latest:
+            raise ValueError(f'Block {block} is not mined on {chain.chain} yet')
+        out = ChainSupplyAtOut(
+            block=block,
+            timestamp=chain.block_timestamp(block),
+            value=chain.value_at(block),
+            finalized=block <= latest - chain.finality_depth
+        )
+        if out.finalized:
+            self._persist({
+                'token': chain.token,
+                'chain': chain.chain,
+                'block': block,
+                'timestamp': out.timestamp,
+                'value': out.value
+            })
+        return out
+
+    def _chain_at_timestamp(self, chain: ChainSupply, timestamp: int) -> Optional[ChainSupplyAtOut]:
+        block = self._blocks.get((chain.token, chain.chain, timestamp))
+        latest = None
+        if block is None:
+            latest = chain.latest_block()
+            block = chain.block_at(timestamp, latest)
+            if block is None:
+                return None
+            # A block mined later could still precede the timestamp until the next one is final
+            if block + 1 <= latest - chain.finality_depth:
+                self._persist({'token': chain.token, 'chain': chain.chain, 'at': timestamp, 'block': block})
+        return self._chain_at_block(chain, block, latest)
+
+    def _read(self, func, chain: ChainSupply, *args) -> Optional[ChainSupplyAtOut]:
+        self._ensure_loaded()
+        try:
+            return func(chain, *args)
+        except ValueError:
+            raise
+        except Exception:
+            error(f'Cannot get historical {chain.token} supply on {chain.chain}')
+            raise SupplyHistoryError(f'Cannot get {chain.token} supply on {chain.chain}')
+
+    async def at_timestamp(self, token_supply: TokenSupply, timestamp: int) -> TokenSupplyAtOut:
+        if timestamp > time():
+            raise ValueError(f'Timestamp {timestamp} is in the future')
+        info(f'Request to get {token_supply.token} supply at {timestamp} received')
+        names = list(token_supply.chains)
+        results = await gather(*[
+            run_in_threadpool(self._read, self._chain_at_timestamp, token_supply.chains[c], timestamp)
+            for c in names
+        ])
+        # Chains started after the timestamp are not listed
+        chains = {c: r for c, r in zip(names, results) if r is not None}
+        return TokenSupplyAtOut(
+            token=token_supply.token,
+            timestamp=timestamp,
+            value=sum([r.value for r in chains.values()], Decimal(0)),
+            chains=chains
+        )
+
+    async def at_block(self, token_supply: TokenSupply, chain: str, block: int) -> TokenSupplyAtOut:
+        info(f'Request to get {token_supply.token} supply at block {block} on {chain} received')
+        out = await run_in_threadpool(self._read, self._chain_at_block, token_supply.chains[chain], block, None)
+        return TokenSupplyAtOut(token=token_supply.token, value=out.value, chains={chain: out})
@@ -0,0 +1,25 @@
+from typing import Optional, Dict
+from decimal import Decimal
+
+from utils.models import ModelWithJSONEncoder, TimestampedBaseModel
+
+class ChainSupplyOut(ModelWithJSONEncoder):
+    value: Optional[Decimal]
+    timestamp: Optional[int]
+
+class TokenSupplyOut(TimestampedBaseModel, ModelWithJSONEncoder):
+    token: str
+    value: Optional[Decimal] # not available until every chain is collected
+    chains: Dict[str, ChainSupplyOut]
+
+class ChainSupplyAtOut(ModelWithJSONEncoder):
+    block: int
+    timestamp: int # of the block
+    value: Decimal
+    finalized: bool
+
+class TokenSupplyAtOut(ModelWithJSONEncoder):
+    token: str
+    timestamp: Optional[int] # requested, absent if a block is requested
+    value: Decimal # total over the chains below
+    chains: Dict[str, ChainSupplyAtOut]
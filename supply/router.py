@@ -1,12 +1,19 @@
-from fastapi import APIRouter, BackgroundTasks
-from fastapi.responses import PlainTextResponse
+from typing import Optional
 
-from asyncio import ensure_future
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Query, Security
+from fastapi.responses import PlainTextResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
-from .web import TotalSupply
+from .web import TotalSupply, TokenSupply
+from .models import TokenSupplyOut, TokenSupplyAtOut
+from .scheduler import SupplyScheduler
+from .history import SupplyHistory, SupplyHistoryError
 
 from utils.settings import Settings
-from utils.misc import async_every
+from utils.misc import check_auth_token
+from utils.models import UploadResponse
+
+_security = HTTPBearer()
 
 _settings = Settings().get()
 
@@ -14,13 +21,58 @@ router = APIRouter()
 
 tasks = BackgroundTasks()
 
+def _token_supply(token: str) -> TokenSupply:
+    token_supply = TotalSupply().token(token)
+    if token_supply is None:
+        raise HTTPException(status_code=404, detail=f'Unknown token {token}')
+    return token_supply
+
 @router.get("/", response_class=PlainTextResponse)
 async def root() -> str:
     return str(TotalSupply().value)
 
+@router.post("/refresh", response_model=UploadResponse)
+async def refresh(credentials: HTTPAuthorizationCredentials = Security(_security)) -> UploadResponse:
+    if not check_auth_token(credentials.credentials):
+        return UploadResponse(status="Incorrect auth token")
+
+    if not await SupplyScheduler().refresh():
+        return UploadResponse(status="Refresh is requested from the leading worker, not completed in time")
+    return UploadResponse(status="success")
+
+# Declared before /{token}, otherwise "at" is taken for a token
+@router.get("/at", response_model=TokenSupplyAtOut, response_model_exclude_none=True)
+async def supply_at(timestamp: Optional[int] = Query(None, ge=0),
+                    block: Optional[int] = Query(None, ge=0),
+                    token: Optional[str] = None,
+                    chain: Optional[str] = None) -> TokenSupplyAtOut:
+    token_supply = _token_supply(token or TotalSupply().default_token)
+    if (timestamp is None) == (block is None):
+        raise HTTPException(status_code=400, detail='Either timestamp or block is expected')
+    try:
+        if timestamp is not None:
+            return await SupplyHistory().at_timestamp(token_supply, timestamp)
+        if chain is None:
+            raise HTTPException(status_code=400, detail='Chain is expected along with block')
+        if not chain in token_supply.chains:
+            raise HTTPException(status_code=404, detail=f'Unknown chain {chain} for {token_supply.token}')
+        return await SupplyHistory().at_block(token_supply, chain, block)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except SupplyHistoryError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+@router.get("/{token}", response_class=PlainTextResponse)
+async def token_root(token: str) -> str:
+    value = _token_supply(token).value
+    return str(value if value is not None else 0)
+
+@router.get("/{token}/chains", response_model=TokenSupplyOut)
+async def token_chains(token: str) -> TokenSupplyOut:
+    return _token_supply(token).out()
+
 @router.on_event("startup")
 async def startup_event():
-    ensure_future(async_every(
-        TotalSupply().get_through_tokens,
-        _settings.update_interval
-    ))
+    # Every chain is refreshed on its own schedule, so a slow or failing
+    # RPC delays only its own entry
+    SupplyScheduler().start()
@@ -0,0 +1,87 @@
+from functools import cache
+from typing import Optional
+from random import uniform
+from time import monotonic
+
+from asyncio import Future, Semaphore, ensure_future, gather, shield, sleep as asleep
+from starlette.concurrency import run_in_threadpool
+
+from .web import TotalSupply
+
+from utils.logging import info
+from utils.settings import Settings
+
+@cache
+class SupplyScheduler():
+    """Refreshes every (token, chain) on its own schedule
+
+    Every chain is checked each `check_interval` seconds with a random
+    jitter, so the RPCs are not hit at the same moment, and no more than
+    `supply_refresh_concurrency` chains are refreshed at once. On-demand
+    refreshes requested while another one is running share its result.
+    With several workers an on-demand refresh requested on a follower is
+    done by the leader, the follower waits for it to complete.
+    """
+    _inflight: Optional[Future]
+
+    def __init__(self):
+        self._semaphore = Semaphore(Settings.get().supply_refresh_concurrency)
+        self._inflight = None
+
+    async def _refresh_chain(self, token: str, chain: str) -> None:
+        async with self._semaphore:
+            await run_in_threadpool(TotalSupply().refresh, token, chain)
+
+    async def _chain_loop(self, token: str, chain: str, interval: int) -> None:
+        jitter = Settings.get().supply_refresh_jitter
+        await asleep(uniform(0, jitter))
+        while True:
+            await self._refresh_chain(token, chain)
+            await asleep(interval + uniform(0, jitter))
+
+    async def _forwarded_loop(self) -> None:
+        interval = Settings.get().supply_refresh_forward_interval
+        total = TotalSupply()
+        while True:
+            await asleep(interval)
+            requested = await run_in_threadpool(total.forwarded_refresh)
+            if requested is not None and total.is_leader():
+                info(f'Refreshing supply on request of another worker')
+                await self.refresh()
+                await run_in_threadpool(total.refreshed, requested)
+
+    def start(self) -> None:
+        for t, token_supply in TotalSupply().tokens.items():
+            for c, chain_supply in token_supply.chains.items():
+                ensure_future(self._chain_loop(t, c, chain_supply.check_interval))
+        if Settings.get().workers > 1:
+            ensure_future(self._forwarded_loop())
+
+    async def _refresh_all(self) -> None:
+        info(f'Refreshing supply on demand')
+        await gather(*[
+            self._refresh_chain(t, c) for t, token_supply in TotalSupply().tokens.items()
+                                      for c in token_supply.chains
+        ])
+
+    async def _forward(self) -> bool:
+        settings = Settings.get()
+        total = TotalSupply()
+        requested = await run_in_threadpool(total.forward_refresh)
+        info(f'Supply refresh is forwarded to the leading worker')
+        deadline = monotonic() + settings.supply_refresh_forward_timeout
+        while monotonic() < deadline:
+            await asleep(settings.supply_refresh_forward_interval)
+            if await run_in_threadpool(total.is_refreshed, requested):
+                return True
+        return False
+
+    async def refresh(self) -> bool:
+        """False if the leader did not complete the refresh in time"""
+        if not TotalSupply().is_leader():
+            return await self._forward()
+        if self._inflight is None or self._inflight.done():
+            self._inflight = ensure_future(self._refresh_all())
+        # shield() lets a cancelled caller leave without interrupting others
+        await shield(self._inflight)
+        return True
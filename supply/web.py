@@ -1,50 +1,284 @@
 from functools import cache
+from typing import Dict, Optional, Tuple
+from threading import Lock
 
 from decimal import Decimal
 
 from time import time
 
-from web3 import Web3, HTTPProvider
+from .models import ChainSupplyOut, TokenSupplyOut
 
-from utils.settings import Settings
-from utils.health import Health, HealthRegistry
+from utils.settings import Settings, SupplyChainSettings, SupplyTokenSettings
+from utils.health import Health, HealthRegistry, WorkerHealthModelBase, WorkerHealthModelOut
+from utils.shared import atomic_dump, load_json, FileVersion, LeaderLock
+from utils.watcher import SnapshotWatcher
 from utils.web3 import ERC20Token
-from utils.logging import info, error
-from utils.misc import format_timestamp
+from utils.logging import info, warning, error
+from utils.misc import format_timestamp, Named
 
 _settings = Settings.get()
 
+class ChainSupply(Health):
+    """totalSupply of the token on one chain
+
+    The value is re-read only if the chain reports mints or burns since the
+    last seen block, or if the value is older than `update_interval`. The
+    latest block number is not requested by a check: the last seen block
+    moves forward with the transfers found, or on the next re-read.
+    """
+    _value: Optional[Decimal]
+    _last_block: Optional[int]
+    _last_read: float
+    _erc20_token: Optional[ERC20Token]
+
+    def __init__(self, token: str, chain: str, address: str, config: SupplyChainSettings):
+        self.token = token
+        self.chain = chain
+        self._name = f'{token}/{chain}'
+        self.update_interval = config.update_interval or _settings.update_interval
+        self.check_interval = config.check_interval or _settings.supply_check_interval
+        self.finality_depth = config.finality_depth if config.finality_depth is not None \
+                              else _settings.supply_finality_depth
+        self._value = None
+        self._last_block = None
+        self._last_read = 0
+        self.initialize_healthdata()
+
+        self._rpc = config.rpc
+        self._address = config.address or address
+        self._erc20_token = None
+
+    @property
+    def value(self) -> Optional[Decimal]:
+        return self._value
+
+    @property
+    def _erc20(self) -> ERC20Token:
+        # Created on the first refresh to keep web3 out of the app start
+        if self._erc20_token is None:
+            from web3 import Web3, HTTPProvider
+            self._erc20_token = ERC20Token(Web3(HTTPProvider(self._rpc)), self._address)
+        return self._erc20_token
+
+    def _changes(self) -> Tuple[Optional[int], bool]:
+        """The last block with transfers since the last seen block and whether the value changed"""
+        if self._value is None or self._last_block is None:
+            return None, True
+        if time() - self._last_read >= self.update_interval:
+            return None, True
+        try:
+            return self._erc20.supply_changes(self._last_block + 1)
+        except:
+            warning(f'Cannot check {self.token} mints and burns on {self.chain}')
+            return None, True
+
+    def refresh(self):
+        try:
+            block, changed = self._changes()
+            if not changed:
+                if block is not None:
+                    self._last_block = block
+                self.record_sucess(int(time()))
+                return
+            # Mints and burns found are included by the value at the last block with transfers
+            if block is None:
+                block = self._erc20.block_number()
+            value = self._erc20.totalSupply(block_identifier=block)
+        except:
+            error(f'Cannot get {self.token} totalSupply on {self.chain}')
+            self.record_error()
+            return
+        self._value = value
+        self._last_block = block
+        self._last_read = time()
+        self.record_sucess(int(time()))
+
+    # Reads of the past, not changing the current value
+
+    def latest_block(self) -> int:
+        return self._erc20.block_number()
+
+    def block_at(self, timestamp: int, latest: int) -> Optional[int]:
+        return self._erc20.block_at(timestamp, latest)
+
+    def block_timestamp(self, block: int) -> int:
+        return self._erc20.block_timestamp(block)
+
+    def value_at(self, block: int) -> Decimal:
+        return self._erc20.totalSupply(block_identifier=block)
+
+    def out(self) -> ChainSupplyOut:
+        return ChainSupplyOut(value=self._value, timestamp=self.healthdata.dataTimestamp)
+
+    def state(self) -> dict:
+        return {'value': self._value, 'health': self.healthdata.dict()}
+
+    def restore(self, state: dict):
+        if state['value'] is not None:
+            self._value = Decimal(state['value'])
+        self.healthdata = WorkerHealthModelBase.parse_obj(state['health'])
+
+class TokenSupply(Named):
+    chains: Dict[str, ChainSupply]
+
+    def __init__(self, token: str, config: SupplyTokenSettings):
+        self.token = token
+        self._name = f'{type(self).__name__}/{token}'
+        self.chains = {}
+        for c in config.chains:
+            self.chains[c] = ChainSupply(token, c, config.address, config.chains[c])
+
+    @property
+    def value(self) -> Optional[Decimal]:
+        total = Decimal(0)
+        for c in self.chains.values():
+            if c.value is None:
+                return None
+            total += c.value
+        return total
+
+    def out(self) -> TokenSupplyOut:
+        return TokenSupplyOut(
+            timestamp=int(time()),
+            token=self.token,
+            value=self.value,
+            chains={c: self.chains[c].out() for c in self.chains}
+        )
+
+    def healthdata_for_publishing(self, curtime: int) -> Dict[str, WorkerHealthModelOut]:
+        info(f'Preparing {self.name()} healthdata for publishing')
+        return {c: self.chains[c].healthdata_for_publishing(curtime) for c in self.chains}
+
 @cache
 class TotalSupply(Health):
+    """Supply of every configured token, collected per chain
+
+    The health of this object reflects the default token, the one served
+    on `/` and `/supply/`.
+    """
+    tokens: Dict[str, TokenSupply]
+    topic = 'supply'
+
     @property
     def value(self):
-        try:
-            return self._value
-        except:
+        value = self.tokens[self.default_token].value
+        if value is None:
             return Decimal(0)
+        return value
 
     def __init__(self):
         self.initialize_healthdata()
         HealthRegistry().append(self)
-        
-        self._tokens = []
-        for u in _settings.rpcs:
-            w3 = Web3(HTTPProvider(u))
-            self._tokens.append(ERC20Token(w3, _settings.bob_token))
 
-    def get_through_tokens(self):
-        total = Decimal(0)
-        collected_successfully = True
-        for t in self._tokens:
-            try: 
-                total += t.totalSupply()
-            except:
-                error(f'Cannot get BOB totalSupply on {t.contract.web3.provider.endpoint_uri}')
-                collected_successfully = False
-                break
-        if collected_successfully:
-            self._value = total
+        self.tokens = {}
+        for t, config in _settings.tokens().items():
+            self.tokens[t] = TokenSupply(t, config)
+            HealthRegistry().append(self.tokens[t])
+        self.default_token = _settings.supply_default_token
+        if not self.default_token in self.tokens:
+            self.default_token = next(iter(self.tokens))
+
+        # With several workers only one of them polls RPCs, the others
+        # read the results it publishes in the shared state file
+        self.state_filename = f'{_settings.snapshot_dir}/{_settings.supply_state_file}'
+        self._leader = LeaderLock(f'{self.state_filename}.lock')
+        self._state_version = FileVersion(self.state_filename)
+        self._state_lock = Lock()
+        self._notified = None
+        # Refreshes requested on other workers are forwarded to the leader through a file
+        self.trigger_filename = f'{self.state_filename}.refresh'
+        self._trigger_version = FileVersion(self.trigger_filename)
+        self._trigger_version.mark()
+        self._refreshed = 0.0 # the latest forwarded request served by the leader
+        if _settings.workers > 1:
+            SnapshotWatcher().watch(self.state_filename, self)
+
+    def token(self, token: str) -> Optional[TokenSupply]:
+        return self.tokens.get(token)
+
+    def _is_follower(self) -> bool:
+        return _settings.workers > 1 and not self._leader.held
+
+    def is_leader(self) -> bool:
+        # A follower takes over as soon as the previous leader is gone
+        return _settings.workers <= 1 or self._leader.acquire()
+
+    def forward_refresh(self) -> float:
+        """Asks the leader to refresh every chain, returns the time of the request"""
+        requested = time()
+        atomic_dump(self.trigger_filename, {'requested': requested})
+        return requested
+
+    def forwarded_refresh(self) -> Optional[float]:
+        """The time of the latest refresh requested by other workers, None if no new one"""
+        if not self._trigger_version.changed():
+            return None
+        self._trigger_version.mark()
+        try:
+            return load_json(self.trigger_filename)['requested']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def refreshed(self, requested: float):
+        # Lets the requesting worker know, all chains are refreshed by now
+        self._refreshed = max(self._refreshed, requested)
+        self._publish()
+
+    def is_refreshed(self, requested: float) -> bool:
+        self.sync()
+        return self._refreshed >= requested
+
+    def _publish(self):
+        with self._state_lock:
+            data = {
+                'health': self.healthdata.dict(),
+                'refreshed': self._refreshed,
+                'tokens': {
+                    t: {c: s.state() for c, s in self.tokens[t].chains.items()} for t in self.tokens
+                }
+            }
+            atomic_dump(self.state_filename, data)
+            self._state_version.mark()
+
+    def sync(self):
+        if not self._is_follower() or not self._state_version.changed():
+            return
+        self._state_version.mark()
+        try:
+            data = load_json(self.state_filename)
+        except (IOError, ValueError):
+            return
+        for t, chains in data['tokens'].items():
+            for c, state in chains.items():
+                if t in self.tokens and c in self.tokens[t].chains:
+                    self.tokens[t].chains[c].restore(state)
+        self.healthdata = WorkerHealthModelBase.parse_obj(data['health'])
+        self._refreshed = data.get('refreshed', 0.0)
+        self.publish_event(self.healthdata.dataTimestamp)
+
+    def event(self, data_ts: int) -> Optional[dict]:
+        # Most refreshes find the supply unchanged, subscribers are notified about changes only
+        values = {t: s.value for t, s in self.tokens.items()}
+        if values == self._notified:
+            return None
+        self._notified = values
+        return {'dataTimestamp': data_ts, 'value': self.value, 'tokens': values}
+
+    def _update_health(self, chain: ChainSupply):
+        if chain.healthdata.status == 'error':
+            self.record_error()
+            return
+        total = self.tokens[self.default_token].value
+        if total is not None:
             self.record_sucess(int(time()))
             info(f'Token total supply is {total} in {format_timestamp()}')
-        else:
-            self.record_error()
\ No newline at end of file
+
+    def refresh(self, token: str, chain: str):
+        if not self.is_leader():
+            return
+        chain_supply = self.tokens[token].chains[chain]
+        chain_supply.refresh()
+        if token == self.default_token:
+            self._update_health(chain_supply)
+        if _settings.workers > 1:
+            self._publish()
@@ -0,0 +1,151 @@
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from math import ceil
+from time import monotonic
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .logging import warning
+from .misc import check_auth_token
+from .settings import Settings, RateLimitSettings
+
+class TokenBucket():
+    """Allows `burst` requests at once and `rate` requests per second on average"""
+
+    def __init__(self, config: RateLimitSettings, now: float):
+        self.rate = config.rate
+        self.burst = config.burst
+        self.tokens = float(config.burst)
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self) -> int:
+        return max(1, ceil((1 - self.tokens) / self.rate))
+
+class AdmissionControl():
+    """Rejects requests before they reach the routes
+
+    Every client (a known API key sent in `X-API-Key`, the IP address otherwise,
+    taken from `X-Forwarded-For` behind `forwarded_hops` proxies) has a token
+    bucket per group of routes, a request over the limit gets 429.
+    No more than `admission_max_concurrency` requests are served at once,
+    others get 503. Both come with `Retry-After`. Requests carrying the upload
+    token and requests to `/health` are never rejected. Requests to `streaming`
+    routes are rate limited but not counted as being served.
+
+    The middleware runs in the event loop only, so the state is not locked.
+    """
+    _buckets: Dict[Tuple[str, str], TokenBucket]
+
+    def __init__(self, app: ASGIApp, streaming: List[str] = []):
+        self.app = app
+        self._streaming = streaming
+        settings = Settings.get()
+        # The longest prefix is matched first
+        self._groups: List[Tuple[str, RateLimitSettings]] = sorted(
+            settings.rate_limits.items(), key=lambda g: len(g[0]), reverse=True
+        )
+        self._max_clients = settings.rate_limit_max_clients
+        self._forwarded_hops = settings.forwarded_hops
+        self._max_concurrency = settings.admission_max_concurrency
+        self._retry_after = settings.admission_retry_after
+        self._api_keys = set(settings.api_keys)
+        self._buckets = OrderedDict() # the least recently seen client first
+        self._active = 0
+
+    @staticmethod
+    def _matches(path: str, prefix: str) -> bool:
+        return path == prefix or path.startswith(prefix.rstrip('/') + '/')
+
+    def _group(self, path: str) -> Optional[Tuple[str, RateLimitSettings]]:
+        for prefix, config in self._groups:
+            if self._matches(path, prefix):
+                return prefix, config
+        return None
+
+    def _bucket(self, key: Tuple[str, str], config: RateLimitSettings, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self._max_clients:
+                # The client not seen for the longest time most likely has a full bucket anyway
+                self._buckets.popitem(last=False)
+            bucket = self._buckets[key] = TokenBucket(config, now)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _client(self, scope: Scope, headers: Headers) -> str:
+        api_key = headers.get('x-api-key')
+        # Unknown keys are ignored, otherwise a client could evade its limit by sending new ones
+        if api_key in self._api_keys:
+            return f'key:{api_key}'
+        if self._forwarded_hops > 0:
+            # Every proxy appends the address it was connected from, entries
+            # before the ones appended by our own proxies are set by the client
+            forwarded = [h.strip() for h in headers.get('x-forwarded-for', '').split(',') if h.strip() != '']
+            if len(forwarded) >= self._forwarded_hops:
+                return f'ip:{forwarded[-self._forwarded_hops]}'
+        client = scope.get('client')
+        return f'ip:{client[0]}' if client else 'ip:unknown'
+
+    @staticmethod
+    def _is_exempt(scope: Scope, headers: Headers) -> bool:
+        if scope['path'] == '/health':
+            return True
+        scheme, _, credentials = headers.get('authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and check_auth_token(credentials)
+
+    async def _reject(self, scope: Scope, receive: Receive, send: Send,
+                      status_code: int, detail: str, retry_after: int):
+        response = JSONResponse({'detail': detail}, status_code=status_code,
+                                headers={'Retry-After': str(retry_after)})
+        await response(scope, receive, send)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        if self._is_exempt(scope, headers):
+            await self.app(scope, receive, send)
+            return
+
+        streaming = any([self._matches(scope['path'], p) for p in self._streaming])
+        if not streaming and self._max_concurrency > 0 and self._active >= self._max_concurrency:
+            warning(f'Rejecting {scope["path"]}: {self._active} requests are being served')
+            await self._reject(scope, receive, send, 503, 'Server is busy', self._retry_after)
+            return
+
+        group = self._group(scope['path'])
+        if group is not None:
+            prefix, config = group
+            client = self._client(scope, headers)
+            now = monotonic()
+            bucket = self._bucket((prefix, client), config, now)
+            if not bucket.take(now):
+                warning(f'Rate limit of {prefix} exceeded by {client}')
+                await self._reject(scope, receive, send, 429, 'Too many requests', bucket.retry_after())
+                return
+
+        if streaming:
+            await self.app(scope, receive, send)
+            return
+
+        self._active += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._active -= 1
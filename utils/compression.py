@@ -0,0 +1,129 @@
+from typing import NamedTuple, Optional
+from io import BytesIO
+from gzip import GzipFile, compress as gzip_compress
+from json import dumps
+from zlib import error as ZlibError
+
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+# Both are optional: without brotli responses are compressed with gzip only,
+# without zstandard uploads compressed with zstd are rejected
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .settings import Settings
+
+_CHUNK_SIZE = 64 * 1024
+
+_DECOMPRESSION_ERRORS = (OSError, EOFError, ZlibError) + ((zstandard.ZstdError,) if zstandard else ())
+
+async def read_body(request: Request) -> bytes:
+    """Reads a request body as it is sent, rejecting it with 413 once it is too large"""
+    limit = Settings.get().upload_max_size
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise HTTPException(status_code=413, detail='Request body is too large')
+    return bytes(body)
+
+def decompress(body: bytes, encoding: Optional[str]) -> bytes:
+    """Decompresses a request body chunk by chunk, so a compression bomb stops at the size limit"""
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return body
+    if encoding == 'gzip':
+        stream = GzipFile(fileobj=BytesIO(body))
+    elif encoding == 'zstd' and zstandard is not None:
+        stream = zstandard.ZstdDecompressor().stream_reader(BytesIO(body), read_across_frames=True)
+    else:
+        raise HTTPException(status_code=415, detail=f'Unsupported Content-Encoding {encoding}')
+
+    limit = Settings.get().upload_max_size
+    content = bytearray()
+    try:
+        with stream:
+            while True:
+                chunk = stream.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                content += chunk
+                if len(content) > limit:
+                    raise HTTPException(status_code=413, detail='Request body is too large')
+    except _DECOMPRESSION_ERRORS:
+        raise HTTPException(status_code=400, detail=f'Cannot decompress {encoding} request body')
+    return bytes(content)
+
+def render(output: BaseModel, **options) -> bytes:
+    """The same JSON as FastAPI produces for the output with response_model_* options"""
+    return dumps(
+        jsonable_encoder(output, **options),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+def _accepted(request: Request) -> list:
+    accepted = []
+    for item in request.headers.get('accept-encoding', '').split(','):
+        encoding, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.append(encoding.strip().lower())
+    return accepted
+
+class EncodedBody(NamedTuple):
+    """A response body with its compressed variants, computed once"""
+    identity: bytes
+    gzip: bytes
+    br: Optional[bytes]
+
+    @classmethod
+    def encode(cls, content: bytes) -> 'EncodedBody':
+        return cls(
+            identity=content,
+            gzip=gzip_compress(content, compresslevel=9),
+            br=brotli.compress(content) if brotli is not None else None
+        )
+
+    def response(self, request: Request) -> Response:
+        if len(self.identity) < Settings.get().compression_min_size:
+            return _response(self.identity, None)
+        accepted = _accepted(request)
+        if self.br is not None and 'br' in accepted:
+            return _response(self.br, 'br')
+        if 'gzip' in accepted:
+            return _response(self.gzip, 'gzip')
+        return _response(self.identity, None)
+
+def compressed_response(request: Request, output: BaseModel, **options) -> Response:
+    """Renders and compresses a body produced for one request only, faster than EncodedBody does"""
+    content = render(output, **options)
+    if len(content) < Settings.get().compression_min_size:
+        return _response(content, None)
+    accepted = _accepted(request)
+    if brotli is not None and 'br' in accepted:
+        return _response(brotli.compress(content, quality=5), 'br')
+    if 'gzip' in accepted:
+        return _response(gzip_compress(content, compresslevel=6), 'gzip')
+    return _response(content, None)
+
+def _response(content: bytes, encoding: Optional[str]) -> Response:
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(content=content, media_type='application/json', headers=headers)
@@ -0,0 +1,109 @@
+from functools import cache
+from typing import Dict, Iterable, NamedTuple, Optional, Set
+from collections import OrderedDict
+from asyncio import AbstractEventLoop, Event as Ready, TimeoutError, get_running_loop, wait_for
+from json import dumps
+
+from .logging import info
+from .misc import CustomJSONEncoder
+from .settings import Settings
+
+class Event(NamedTuple):
+    id: int
+    topic: str
+    data: dict
+
+    def json(self) -> str:
+        return dumps(self.data, cls=CustomJSONEncoder)
+
+class Subscription():
+    """Events of the topics a client subscribed to, waiting to be sent
+
+    An event replaces an undelivered event of the same topic, so a slow
+    client never holds more than one event per topic and still gets the
+    latest state of every topic once it catches up.
+    """
+    _pending: Dict[str, Event]
+
+    def __init__(self, topics: Set[str]):
+        self.topics = topics
+        self.replaced = 0
+        self._pending = OrderedDict()
+        self._ready = Ready()
+
+    def put(self, event: Event):
+        if self._pending.pop(event.topic, None) is not None:
+            self.replaced += 1
+        self._pending[event.topic] = event
+        self._ready.set()
+
+    async def get(self, timeout: float) -> Optional[Event]:
+        """The oldest pending event, None if nothing is published within the timeout"""
+        if len(self._pending) == 0:
+            self._ready.clear()
+            try:
+                await wait_for(self._ready.wait(), timeout)
+            except TimeoutError:
+                return None
+        _, event = self._pending.popitem(last=False)
+        return event
+
+@cache
+class EventBroker():
+    """Pushes notifications about new data to subscribed clients
+
+    Events are published from any thread and fanned out in the event loop,
+    which owns all subscriptions, so no locks are needed. The latest event
+    of every topic is kept and sent to a client right after it subscribes.
+    """
+    _loop: Optional[AbstractEventLoop]
+    _subscribers: Dict[str, Set[Subscription]]
+    _latest: Dict[str, Event]
+
+    def __init__(self):
+        self._max_subscribers = Settings.get().events_max_subscribers
+        self._loop = None
+        self._subscribers = {}
+        self._latest = {}
+        self._count = 0
+        self._next_id = 1
+
+    def start(self):
+        # Called in the event loop on start, events published before are dropped
+        self._loop = get_running_loop()
+
+    def publish(self, topic: str, data: dict) -> None:
+        if self._loop is None:
+            return
+        self._loop.call_soon_threadsafe(self._fanout, topic, data)
+
+    def _fanout(self, topic: str, data: dict):
+        event = Event(self._next_id, topic, data)
+        self._next_id += 1
+        self._latest[topic] = event
+        for s in self._subscribers.get(topic, ()):
+            s.put(event)
+
+    def is_full(self) -> bool:
+        return self._count >= self._max_subscribers
+
+    def subscribe(self, topics: Iterable[str]) -> Subscription:
+        subscription = Subscription(set(topics))
+        for t in subscription.topics:
+            self._subscribers.setdefault(t, set()).add(subscription)
+            if t in self._latest:
+                subscription.put(self._latest[t])
+        self._count += 1
+        info(f'Subscribed to {", ".join(sorted(subscription.topics))}, {self._count} subscriptions')
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        removed = False
+        for t in subscription.topics:
+            subscribers = self._subscribers.get(t, set())
+            if subscription in subscribers:
+                subscribers.discard(subscription)
+                removed = True
+        if removed:
+            self._count -= 1
+            info(f'Unsubscribed, {self._count} subscriptions left ({subscription.replaced} events replaced)')
@@ -0,0 +1,73 @@
+from functools import cache
+from typing import Any, Callable, Optional, Type
+from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from asyncio import wait_for, wrap_future, TimeoutError as WaitTimeoutError
+
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+
+from .compression import decompress
+from .logging import warning
+from .profiling import current_request_profile
+from .settings import Settings
+
+@cache
+class BoundedExecutor():
+    """Runs file I/O and parsing of route handlers out of the event loop
+
+    No more than `executor_workers` operations run at once and no more than
+    `executor_queue_limit` wait for a worker; beyond that a request is rejected
+    with 503 right away. An operation not completed in time is answered with
+    504, it still runs to the end in the worker if it has already started.
+    """
+
+    def __init__(self):
+        settings = Settings.get()
+        self._pool = ThreadPoolExecutor(max_workers=settings.executor_workers, thread_name_prefix='executor')
+        self._limit = settings.executor_workers + settings.executor_queue_limit
+        self._timeout = settings.executor_timeout
+        self._retry_after = settings.executor_retry_after
+        self._pending = 0
+        self._lock = Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _release(self, _: Future):
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, func: Callable, *args, timeout: Optional[int] = None, **kwargs) -> Any:
+        with self._lock:
+            if self._pending >= self._limit:
+                warning(f'Rejecting {func.__qualname__}: {self._pending} operations are pending')
+                raise HTTPException(
+                    status_code=503,
+                    detail='Server is busy',
+                    headers={'Retry-After': str(self._retry_after)}
+                )
+            self._pending += 1
+        name = func.__qualname__
+        profile = current_request_profile()
+        if profile is not None:
+            func, args = profile.run, (func, *args)
+        future = self._pool.submit(func, *args, **kwargs)
+        future.add_done_callback(self._release)
+        try:
+            return await wait_for(wrap_future(future), timeout or self._timeout)
+        except WaitTimeoutError:
+            warning(f'{name} is not completed in {timeout or self._timeout} seconds')
+            raise HTTPException(status_code=504, detail='Operation timed out')
+
+def parse_body(model: Type[BaseModel], body: bytes, encoding: Optional[str] = None) -> BaseModel:
+    """Parses a request body the way FastAPI does, errors are reported with 422"""
+    body = decompress(body, encoding)
+    try:
+        return model.parse_raw(body)
+    except ValidationError as e:
+        raise RequestValidationError([ErrorWrapper(e, loc=('body',))])
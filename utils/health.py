@@ -8,6 +8,7 @@ from pydantic import BaseModel, ValidationError
 from .models import TimestampedBaseModel
 from .misc import format_timestamp, Named
 from .logging import warning, info
+from .events import EventBroker
 
 class WorkerHealthModelBase(BaseModel):
     status: str
@@ -21,20 +22,36 @@ class WorkerHealthModelOut(WorkerHealthModelBase):
     lastErrorDatetime: Optional[str]
     secondsSinceLastError: Optional[int]
 
+class QueueHealthModelOut(WorkerHealthModelOut):
+    pending: int
+    lagSeconds: int # age of the oldest item not processed yet
+    failures: int
+
 class HealthOut(BaseModel):
     currentDatetime: str
-    modules: Dict[str, Union[WorkerHealthModelOut, Dict[str, WorkerHealthModelOut]]]
+    # The most specific model goes first, pydantic takes the first one matching
+    modules: Dict[str, Union[QueueHealthModelOut, WorkerHealthModelOut, Dict[str, WorkerHealthModelOut]]]
 
 class HealthException(Exception):
     pass
 
 class Health(Named):
     healthdata: WorkerHealthModelBase
+    # Subsystems notifying subscribers about new data set the topic
+    topic: Optional[str] = None
 
     def _load(self) -> TimestampedBaseModel:
         warning(f'Considering {self.name()} not healthy since no data found')
         raise HealthException
 
+    def _load_timestamp(self) -> int:
+        # Subsystems able to get the data timestamp without loading the data override this
+        data = self._load()
+        try:
+            return data.timestamp
+        except AttributeError:
+            return data['timestamp']
+
     def initialize_healthdata(self):
         self.healthdata = WorkerHealthModelBase(
             status='error',
@@ -42,20 +59,31 @@ class Health(Named):
             lastErrorTimestamp=0
         )
         try:
-            data = self._load()
-            try:
-                data_ts = data.timestamp
-            except AttributeError:
-                data_ts = data['timestamp']
-            self.record_sucess(data_ts, False)
-        except (IOError, ValidationError, HealthException):
+            self.record_sucess(self._load_timestamp(), False)
+        except (IOError, ValidationError, HealthException, KeyError):
             pass
         
+    def sync(self) -> None:
+        # Picks up the data published by other workers, nothing to do by default
+        pass
+
     def record_sucess(self, data_ts: int, record_curtime: bool = True):
         self.healthdata.status = 'success'
         self.healthdata.dataTimestamp = data_ts
         if record_curtime:
             self.healthdata.lastSuccessTimestamp = int(time())
+            self.publish_event(data_ts)
+
+    def event(self, data_ts: int) -> Optional[dict]:
+        # None if there is nothing new to notify about
+        return {'dataTimestamp': data_ts}
+
+    def publish_event(self, data_ts: int):
+        if self.topic is None:
+            return
+        data = self.event(data_ts)
+        if data is not None:
+            EventBroker().publish(self.topic, data)
 
     def record_error(self):
         self.healthdata.status = 'error'
@@ -63,6 +91,7 @@ class Health(Named):
 
     def healthdata_for_publishing(self, curtime: int) -> WorkerHealthModelOut:
         info(f'Preparing {self.name()} healthdata for publishing')
+        self.sync()
         hd = WorkerHealthModelOut.parse_obj(self.healthdata)
 
         hd.lastSuccessDatetime = format_timestamp(hd.lastSuccessTimestamp)
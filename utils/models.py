@@ -1,7 +1,14 @@
 from typing import Optional, Dict
+from decimal import Decimal
 
 from pydantic import BaseModel
 
+class ModelWithJSONEncoder(BaseModel):
+    class Config:
+        json_encoders = {
+            Decimal: lambda v: str(v)
+        }
+
 class TimestampedBaseModel(BaseModel):
     timestamp: int
 
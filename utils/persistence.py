@@ -0,0 +1,129 @@
+from functools import cache, partial
+from typing import Callable, Dict, Hashable, NamedTuple, Optional, Tuple
+from threading import Condition, Thread
+from time import monotonic, time
+
+from .health import Health, HealthRegistry, WorkerHealthModelBase, QueueHealthModelOut
+from .logging import info, error
+from .settings import Settings
+
+class PendingWrite(NamedTuple):
+    write: Callable[[], None]
+    since: float # when the oldest data not written yet was submitted
+    not_before: float
+    retry: bool = False
+
+@cache
+class WriteBehind(Health):
+    """Writes uploaded data to the storage after the upload is answered
+
+    Writes are done one by one by a background thread. A write submitted
+    for a key with a write still pending replaces it, so a burst of uploads
+    of the same snapshot ends up in a single write done `write_behind_delay`
+    seconds after the first one. A failed write is retried unless a newer
+    one replaces it. With `write_behind` disabled the data is written right
+    away, in the upload request.
+    """
+    _pending: Dict[Hashable, PendingWrite]
+    _in_progress: Optional[float]
+
+    def __init__(self):
+        settings = Settings.get()
+        self._enabled = settings.write_behind
+        self._delay = settings.write_behind_delay
+        self._retry_delay = settings.write_behind_retry_delay
+        self._pending = {}
+        self._in_progress = None
+        self._flushing = False
+        self._failures = 0
+        self._condition = Condition()
+        self._thread = None
+
+        self.healthdata = WorkerHealthModelBase(
+            status='success',
+            lastSuccessTimestamp=0,
+            lastErrorTimestamp=0
+        )
+        HealthRegistry().append(self)
+
+    def submit(self, key: Hashable, func: Callable, *args) -> None:
+        write = partial(func, *args)
+        if not self._enabled:
+            write()
+            return
+        with self._condition:
+            now = monotonic()
+            previous = self._pending.get(key)
+            self._pending[key] = PendingWrite(
+                write,
+                previous.since if previous else now,
+                previous.not_before if previous else now + self._delay
+            )
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _next(self) -> Hashable:
+        # Called with the condition held, waits for a write to become due
+        while True:
+            if len(self._pending) == 0:
+                self._condition.wait()
+                continue
+            key = min(self._pending, key=lambda k: self._pending[k].not_before)
+            wait = self._pending[key].not_before - monotonic()
+            # Retries are delayed even by a flush, not to spin on a failing storage
+            if wait <= 0 or (self._flushing and not self._pending[key].retry):
+                return key
+            self._condition.wait(wait)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                key = self._next()
+                pending = self._pending.pop(key)
+                self._in_progress = pending.since
+            try:
+                pending.write()
+                self.record_sucess(int(time()))
+            except Exception:
+                error(f'Cannot write {key}, retrying in {self._retry_delay} seconds')
+                self._failures += 1
+                self.record_error()
+                with self._condition:
+                    # A newer write of the same key makes this one obsolete
+                    if not key in self._pending:
+                        self._pending[key] = pending._replace(not_before=monotonic() + self._retry_delay, retry=True)
+            finally:
+                with self._condition:
+                    self._in_progress = None
+                    self._condition.notify_all()
+
+    def flush(self, timeout: float) -> bool:
+        """Writes everything pending without delay, False if not done in time"""
+        deadline = monotonic() + timeout
+        with self._condition:
+            self._flushing = True
+            self._condition.notify_all()
+            while len(self._pending) > 0 or self._in_progress is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            self._flushing = False
+            done = len(self._pending) == 0 and self._in_progress is None
+        info(f'Pending writes {"completed" if done else "not completed"}')
+        return done
+
+    def _backlog(self) -> Tuple[int, int]:
+        with self._condition:
+            since = [p.since for p in self._pending.values()]
+            if self._in_progress is not None:
+                since.append(self._in_progress)
+            count = len(self._pending)
+        return (count, int(monotonic() - min(since)) if len(since) > 0 else 0)
+
+    def healthdata_for_publishing(self, curtime: int) -> QueueHealthModelOut:
+        hd = super().healthdata_for_publishing(curtime)
+        pending, lag = self._backlog()
+        return QueueHealthModelOut(**hd.dict(), pending=pending, lagSeconds=lag, failures=self._failures)
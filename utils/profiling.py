@@ -0,0 +1,196 @@
+from functools import cache
+from typing import Callable, Dict, Optional
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from threading import Lock, enumerate as threads, get_ident
+from time import monotonic, sleep
+from io import StringIO
+from uuid import uuid4
+
+import sys
+import cProfile
+import marshal
+import pstats
+import tracemalloc
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .logging import info
+from .misc import check_auth_token
+from .settings import Settings
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+
+def sample_stacks(seconds: float, interval: float) -> str:
+    """Wall-clock sampling profile of every thread, in the collapsed stacks format
+
+    Every line is `thread;outermost frame;...;innermost frame count`, ready
+    for flamegraph.pl or speedscope.
+    """
+    own = get_ident()
+    counts = Counter()
+    deadline = monotonic() + seconds
+    while monotonic() < deadline:
+        names = {t.ident: t.name for t in threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[';'.join(reversed(stack))] += 1
+        sleep(interval)
+    return ''.join([f'{stack} {count}\n' for stack, count in counts.most_common()])
+
+class RequestProfile():
+    """cProfile statistics of the work done for one request in the executor pool"""
+
+    def __init__(self, path: str):
+        self.id = uuid4().hex
+        self.path = path
+        self.elapsed = None
+        self._started = monotonic()
+        self._stats = pstats.Stats()
+        self._lock = Lock()
+
+    def run(self, func: Callable, *args, **kwargs):
+        # A profiler collects calls of its own thread only, so one is created per call
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._stats.add(profile)
+
+    def finish(self):
+        self.elapsed = monotonic() - self._started
+
+    def text(self, limit: int) -> str:
+        output = StringIO()
+        output.write(f'{self.path} served in {self.elapsed:.6f} seconds\n')
+        with self._lock:
+            if len(self._stats.stats) == 0:
+                output.write('No work done in the executor pool\n')
+            else:
+                self._stats.stream = output
+                self._stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+    def dump(self) -> bytes:
+        """The same content as pstats.Stats.dump_stats() writes to a file"""
+        with self._lock:
+            return marshal.dumps(self._stats.stats)
+
+_request_profile: ContextVar[Optional[RequestProfile]] = ContextVar('request_profile', default=None)
+
+def current_request_profile() -> Optional[RequestProfile]:
+    return _request_profile.get()
+
+class RequestProfiling():
+    """Profiles a request sent with `X-Profile: 1` and the upload token
+
+    The response carries `X-Profile-Id` to fetch the profile by.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    @staticmethod
+    def _requested(headers: Headers) -> bool:
+        if headers.get('x-profile', '') in ('', '0'):
+            return False
+        scheme, _, credentials = headers.get('authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and check_auth_token(credentials)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or not self._requested(Headers(scope=scope)):
+            await self.app(scope, receive, send)
+            return
+
+        profile = Profiler().start_request(scope['path'])
+
+        async def send_with_id(message: Message):
+            if message['type'] == 'http.response.start':
+                MutableHeaders(scope=message).append('X-Profile-Id', profile.id)
+            await send(message)
+
+        token = _request_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _request_profile.reset(token)
+            profile.finish()
+
+@cache
+class Profiler():
+    """Keeps the latest request profiles and the paths loading snapshots"""
+    _requests: Dict[str, RequestProfile]
+    _load_paths: Dict[str, Callable[[], object]]
+
+    def __init__(self):
+        self._kept = Settings.get().profiling_kept_requests
+        self._requests = OrderedDict()
+        self._load_paths = {}
+        self._lock = Lock()
+        self.sampling = Lock()
+        self._tracing = Lock()
+
+    def start_request(self, path: str) -> RequestProfile:
+        profile = RequestProfile(path)
+        info(f'Profiling {path} as {profile.id}')
+        with self._lock:
+            self._requests[profile.id] = profile
+            while len(self._requests) > self._kept:
+                self._requests.popitem(last=False)
+        return profile
+
+    def request(self, id: str) -> Optional[RequestProfile]:
+        with self._lock:
+            return self._requests.get(id)
+
+    def register_load_path(self, name: str, load: Callable[[], object]) -> None:
+        self._load_paths[name] = load
+
+    def allocations(self, limit: int) -> str:
+        """Memory allocated by every registered path loading a snapshot, by source line
+
+        Allocations of other threads running at the same time are counted too.
+        """
+        with self._tracing:
+            return self._allocations(limit)
+
+    def _allocations(self, limit: int) -> str:
+        output = StringIO()
+        for name, load in self._load_paths.items():
+            # Tracing is on only while a path is loading, it slows allocations down a lot
+            was_tracing = tracemalloc.is_tracing()
+            if not was_tracing:
+                tracemalloc.start()
+            tracemalloc.clear_traces()
+            tracemalloc.reset_peak()
+            started = monotonic()
+            loaded, failure = None, None
+            try:
+                # Kept until the snapshot is taken to count the memory the loaded data takes
+                loaded = load()
+            except Exception as e:
+                failure = e
+            elapsed = monotonic() - started
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            del loaded
+            if not was_tracing:
+                tracemalloc.stop()
+
+            if failure is not None:
+                output.write(f'{name}: failed to load: {failure!r}\n')
+                continue
+            output.write(f'{name}: loaded in {elapsed:.6f} seconds, {current} bytes retained, {peak} bytes at peak\n')
+            for stat in snapshot.statistics('lineno')[:limit]:
+                output.write(f'    {stat}\n')
+        return output.getvalue()
@@ -1,17 +1,34 @@
 from functools import cache
 
-from pydantic import BaseSettings
+from pydantic import BaseSettings, BaseModel
 from pydantic.utils import GetterDict
 
-from typing import Any, List
+from typing import Any, List, Dict, Optional
+from urllib.parse import urlparse
 
 from .logging import info
 
 __secrets__ = {
-    'upload_token': 'default'
+    'upload_token': 'default',
+    'api_keys': []
 }
 
-__comma_separated_params__ = ['rpcs' , 'bobvault_chains']
+__comma_separated_params__ = ['rpcs' , 'bobvault_chains', 'api_keys']
+
+class SupplyChainSettings(BaseModel):
+    rpc: str
+    address: Optional[str] # the token address if not specified
+    update_interval: Optional[int] # update_interval if not specified
+    check_interval: Optional[int] # supply_check_interval if not specified
+    finality_depth: Optional[int] # supply_finality_depth if not specified
+
+class SupplyTokenSettings(BaseModel):
+    address: Optional[str]
+    chains: Dict[str, SupplyChainSettings]
+
+class RateLimitSettings(BaseModel):
+    rate: float # requests per second
+    burst: int # requests allowed at once after a quiet period
 
 class Settings(BaseSettings):
     rpcs: List[str] = ['https://polygon-rpc.com', 'https://mainnet.optimism.io']
@@ -23,22 +40,81 @@ class Settings(BaseSettings):
     snapshot_dir: str = '.'
     coingecko_snapshot_file_template: str = 'bobvault-{chain}-coingecko-data.json'
     bobstat_snapshot_file: str = 'bobstat-data.json'
+    bobstat_history_file: str = 'bobstat-history.jsonl'
+    bobstat_yield_sources_file: str = 'bobstat-yield-sources.json'
+    bobstat_main_yield_source: str = 'main'
     bobvault_chains: List[str] = ['polygon', 'bsc', 'mainnet', 'eth-opt', 'arbitrum1']
     web3_retry_attemtps: int = 2
     web3_retry_delay: int = 5
+    workers: int = 1
+    supply_state_file: str = 'supply-state.json'
+    snapshot_watch_interval: int = 2
+    storage_backend: str = 'json' # json or sqlite
+    sqlite_file: str = 'snapshots.sqlite3'
+    sqlite_uploads_retention: int = 48
+    # JSON, e.g. {"bob": {"address": "0x...", "chains": {"polygon": {"rpc": "https://..."}}}}
+    supply_tokens: Dict[str, SupplyTokenSettings] = {}
+    supply_default_token: str = 'bob'
+    supply_check_interval: int = 1800 # a check costs one RPC call
+    supply_refresh_jitter: int = 5
+    supply_refresh_concurrency: int = 4
+    supply_refresh_forward_interval: float = 0.5 # how often workers check for forwarded refreshes
+    supply_refresh_forward_timeout: int = 30
+    supply_history_file: str = 'supply-history.jsonl'
+    supply_finality_depth: int = 128 # blocks this deep are not expected to be reorganized
+    executor_workers: int = 8
+    executor_queue_limit: int = 32 # requests waiting for a free worker, 503 beyond that
+    executor_timeout: int = 10
+    executor_upload_timeout: int = 60
+    executor_retry_after: int = 1
+    upload_max_size: int = 64 * 1024 * 1024 # bytes, after decompression
+    compression_min_size: int = 500 # smaller responses are not compressed
+    bulk_trades_default_limit: int = 100 # trades per ticker and type
+    bulk_trades_max_limit: int = 1000
+    # JSON, requests of every client to every group of routes (by path prefix) are limited separately
+    rate_limits: Dict[str, RateLimitSettings] = {
+        '/coingecko/bobvault': RateLimitSettings(rate=10, burst=40),
+        '/bobstats': RateLimitSettings(rate=5, burst=20),
+        '/supply': RateLimitSettings(rate=10, burst=40)
+    }
+    rate_limit_max_clients: int = 10000
+    forwarded_hops: int = 0 # proxies in front of the app appending to X-Forwarded-For, 1 on Heroku
+    api_keys: List[str] = __secrets__['api_keys'] # consumers limited by key rather than by IP address
+    admission_max_concurrency: int = 64 # requests served at once, 0 for no limit
+    admission_retry_after: int = 1
+    write_behind: bool = True # uploads are written to the storage after they are answered
+    write_behind_delay: float = 0.5 # uploads of the same data within this time are written once
+    write_behind_retry_delay: int = 5
+    write_behind_flush_timeout: int = 10 # on shutdown
+    profiling_max_seconds: int = 60
+    profiling_kept_requests: int = 20
+    events_max_subscribers: int = 1000 # per worker, 503 beyond that
+    events_keepalive: int = 15 # seconds between messages to an idle subscriber
 
     @classmethod
     @cache
     def get(cls):
-        settings = cls()
+        return cls()
 
-        for (key, value) in settings:
+    def log(self):
+        for (key, value) in self:
             if (key in __secrets__) and (value != __secrets__[key]):
                 info(f'{key.upper()} is set')
             else:
                 info(f'{key.upper()} = {value}')
 
-        return settings
+    def tokens(self) -> Dict[str, SupplyTokenSettings]:
+        if len(self.supply_tokens) > 0:
+            return self.supply_tokens
+        # Legacy configuration: one token with the same address on every RPC
+        return {
+            self.supply_default_token: SupplyTokenSettings(
+                address=self.bob_token,
+                chains={
+                    urlparse(u).hostname or u: SupplyChainSettings(rpc=u) for u in self.rpcs
+                }
+            )
+        }
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,109 @@
+from typing import Callable, Optional, Tuple, TextIO
+from json import dump, load
+from os import replace, stat, fsync, getpid, fdopen, fchmod, umask, unlink
+from os.path import dirname
+from tempfile import mkstemp
+
+from fcntl import flock, LOCK_EX, LOCK_NB
+
+from .logging import info
+from .misc import CustomJSONEncoder
+
+# Helpers to share state between several uvicorn workers through files.
+# Files are always replaced atomically so a reader never sees a partially
+# written snapshot.
+
+# umask() can only be read by setting it, this is done once before any threads start
+_UMASK = umask(0)
+umask(_UMASK)
+
+def atomic_write(filename: str, write: Callable[[TextIO], None]) -> None:
+    fd, tmp_filename = mkstemp(dir=dirname(filename) or '.', suffix='.tmp')
+    try:
+        # mkstemp creates files readable by the owner only, unlike open()
+        fchmod(fd, 0o666 & ~_UMASK)
+        with fdopen(fd, 'w') as tmp_file:
+            write(tmp_file)
+            tmp_file.flush()
+            fsync(tmp_file.fileno())
+        replace(tmp_filename, filename)
+    except:
+        try:
+            unlink(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+def atomic_dump(filename: str, data: dict) -> None:
+    atomic_write(filename, lambda json_file: dump(data, json_file, cls=CustomJSONEncoder))
+
+def load_json(filename: str) -> dict:
+    with open(filename, 'r') as json_file:
+        return load(json_file)
+
+FileVersionStamp = Tuple[int, int, int]
+
+def file_stamp(filename: str) -> Optional[FileVersionStamp]:
+    try:
+        st = stat(filename)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class FileVersion():
+    """Tracks whether a file was replaced or modified since it was last seen"""
+    _seen: Optional[FileVersionStamp]
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._seen = None
+
+    def current(self) -> Optional[FileVersionStamp]:
+        return file_stamp(self.filename)
+
+    def changed(self) -> bool:
+        return self.current() != self._seen
+
+    def mark(self) -> None:
+        self._seen = self.current()
+
+class FileLock():
+    """Blocking exclusive lock shared by the workers and threads of all processes"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = None
+
+    def __enter__(self):
+        # Every holder opens the file on its own, flock excludes separate open files
+        self._file = open(self.filename, 'a')
+        flock(self._file.fileno(), LOCK_EX)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        self._file = None
+
+class LeaderLock():
+    """Non-blocking exclusive lock used to elect one worker among several"""
+    _file: Optional[TextIO]
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = None
+
+    def acquire(self) -> bool:
+        if self._file:
+            return True
+        lock_file = open(self.filename, 'a')
+        try:
+            flock(lock_file.fileno(), LOCK_EX | LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        info(f'Worker {getpid()} holds {self.filename}')
+        self._file = lock_file
+        return True
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
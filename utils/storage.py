@@ -0,0 +1,203 @@
+from abc import ABC, abstractmethod
+from functools import cache
+from typing import Any, Callable, Hashable, List, TextIO
+from threading import Lock
+from json import dumps, loads
+
+import sqlite3
+
+from .logging import info
+from .misc import CustomJSONEncoder
+from .settings import Settings
+from .shared import atomic_dump, atomic_write, load_json, file_stamp, FileLock
+
+class DocumentStorage(ABC):
+    """Keeps JSON documents (whole snapshots) by key"""
+
+    @abstractmethod
+    def save(self, key: str, data: dict) -> None:
+        ...
+
+    @abstractmethod
+    def load(self, key: str) -> dict:
+        """Raises IOError if there is no document stored under the key"""
+
+    @abstractmethod
+    def version(self, key: str) -> Hashable:
+        """Changes every time the document is replaced"""
+
+    @abstractmethod
+    def source(self, key: str) -> str:
+        """The file to watch for changes of the document"""
+
+    @abstractmethod
+    def append_record(self, key: str, record: dict) -> None:
+        """Appends a record to the append-only log stored under the key"""
+
+    @abstractmethod
+    def load_records(self, key: str) -> List[dict]:
+        """All records of the log in the order they were appended, empty if none"""
+
+    @abstractmethod
+    def compact_records(self, key: str, compact: Callable[[List[dict]], List[dict]]) -> List[dict]:
+        """Replaces the log with `compact(records)` and returns the result
+
+        No record can be appended meanwhile, by this process or any other.
+        """
+
+class JSONFileStorage(DocumentStorage):
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def source(self, key: str) -> str:
+        return f'{self.directory}/{key}'
+
+    def save(self, key: str, data: dict) -> None:
+        atomic_dump(self.source(key), data)
+
+    def load(self, key: str) -> dict:
+        return load_json(self.source(key))
+
+    def version(self, key: str) -> Hashable:
+        return file_stamp(self.source(key))
+
+    # Logs are kept as JSON lines, so a record is appended without rewriting the file.
+    # Appends and compaction take the same lock, the log is opened once it is held,
+    # so a record is never appended to a file being replaced
+
+    def _log_lock(self, key: str) -> FileLock:
+        return FileLock(f'{self.source(key)}.lock')
+
+    def append_record(self, key: str, record: dict) -> None:
+        with self._log_lock(key):
+            with open(self.source(key), 'a') as log_file:
+                log_file.write(dumps(record, cls=CustomJSONEncoder) + '\n')
+
+    def load_records(self, key: str) -> List[dict]:
+        try:
+            with open(self.source(key), 'r') as log_file:
+                return [loads(line) for line in log_file if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def compact_records(self, key: str, compact: Callable[[List[dict]], List[dict]]) -> List[dict]:
+        with self._log_lock(key):
+            records = compact(self.load_records(key))
+            def write(log_file: TextIO):
+                for record in records:
+                    log_file.write(dumps(record, cls=CustomJSONEncoder) + '\n')
+            atomic_write(self.source(key), write)
+        return records
+
+@cache
+class SQLiteDatabase():
+    """One connection per process to the embedded database, shared by the threadpool"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        info(f'Opening {filename}')
+        # Rollback journal (not WAL) is used deliberately: every commit touches
+        # the main file, so the snapshot watcher notices changes made by others
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA busy_timeout = 5000')
+        self.lock = Lock()
+
+    def execute(self, sql: str, parameters: Any = ()) -> list:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def transaction(self, mode: str = 'IMMEDIATE') -> 'SQLiteTransaction':
+        """IMMEDIATE for writes, DEFERRED for several reads from the same state of the database"""
+        return SQLiteTransaction(self, mode)
+
+class SQLiteTransaction():
+    def __init__(self, db: SQLiteDatabase, mode: str):
+        self.db = db
+        self.mode = mode
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.db.lock.acquire()
+        try:
+            self.db.connection.execute(f'BEGIN {self.mode}')
+        except:
+            # E.g. the database is locked by another process longer than busy_timeout
+            self.db.lock.release()
+            raise
+        return self.db.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.db.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.db.lock.release()
+
+class SQLiteDocumentStorage(DocumentStorage):
+    def __init__(self, db: SQLiteDatabase):
+        self.db = db
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                key TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
+                data TEXT NOT NULL
+            )
+        ''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS records (
+                key TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (key, seq)
+            )
+        ''')
+
+    def source(self, key: str) -> str:
+        return self.db.filename
+
+    def save(self, key: str, data: dict) -> None:
+        self.db.execute('''
+            INSERT INTO documents (key, version, data) VALUES (?, 1, ?)
+            ON CONFLICT (key) DO UPDATE SET version = version + 1, data = excluded.data
+        ''', (key, dumps(data, cls=CustomJSONEncoder)))
+
+    def load(self, key: str) -> dict:
+        rows = self.db.execute('SELECT data FROM documents WHERE key = ?', (key,))
+        if len(rows) == 0:
+            raise IOError(f'No {key} document in {self.db.filename}')
+        return loads(rows[0][0])
+
+    def version(self, key: str) -> Hashable:
+        rows = self.db.execute('SELECT version FROM documents WHERE key = ?', (key,))
+        return rows[0][0] if len(rows) > 0 else None
+
+    def append_record(self, key: str, record: dict) -> None:
+        self.db.execute('''
+            INSERT INTO records (key, seq, data)
+            SELECT ?, COALESCE(MAX(seq), 0) + 1, ? FROM records WHERE key = ?
+        ''', (key, dumps(record, cls=CustomJSONEncoder), key))
+
+    def load_records(self, key: str) -> List[dict]:
+        rows = self.db.execute('SELECT data FROM records WHERE key = ? ORDER BY seq', (key,))
+        return [loads(r[0]) for r in rows]
+
+    def compact_records(self, key: str, compact: Callable[[List[dict]], List[dict]]) -> List[dict]:
+        # IMMEDIATE takes the write lock before reading, appends of other processes wait for the commit
+        with self.db.transaction() as c:
+            rows = c.execute('SELECT data FROM records WHERE key = ? ORDER BY seq', (key,)).fetchall()
+            records = compact([loads(r[0]) for r in rows])
+            c.execute('DELETE FROM records WHERE key = ?', (key,))
+            c.executemany(
+                'INSERT INTO records (key, seq, data) VALUES (?, ?, ?)',
+                [(key, i + 1, dumps(r, cls=CustomJSONEncoder)) for i, r in enumerate(records)]
+            )
+        return records
+
+def sqlite_database() -> SQLiteDatabase:
+    settings = Settings.get()
+    return SQLiteDatabase(f'{settings.snapshot_dir}/{settings.sqlite_file}')
+
+@cache
+def document_storage() -> DocumentStorage:
+    settings = Settings.get()
+    if settings.storage_backend == 'sqlite':
+        return SQLiteDocumentStorage(sqlite_database())
+    return JSONFileStorage(settings.snapshot_dir)
@@ -0,0 +1,77 @@
+from functools import cache
+from typing import Dict, List, Optional, Iterable
+from os.path import basename
+from time import monotonic
+
+from asyncio import sleep as asleep
+from starlette.concurrency import run_in_threadpool
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from .health import Health
+from .logging import info, warning
+from .settings import Settings
+
+@cache
+class SnapshotWatcher():
+    """Watches snapshot_dir and lets registered subsystems reload changed files
+
+    Every registered item decides on its own in `sync()` whether its file
+    was really changed, so the watcher only needs to tell which items could
+    be affected. inotify is used to react on changes immediately, polling
+    with `snapshot_watch_interval` is kept anyway since inotify does not
+    see changes made through a shared (network) volume by other nodes.
+    """
+    _items: Dict[str, List[Health]]
+
+    def __init__(self):
+        self._items = {}
+        self._polled_at = monotonic()
+
+    def watch(self, filename: str, item: Health) -> None:
+        info(f'Watching {filename} for {item.name()}')
+        self._items.setdefault(basename(filename), []).append(item)
+
+    def _inotify(self) -> Optional['INotify']:
+        if INotify is None:
+            info(f'inotify is not available, polling {Settings.get().snapshot_dir} for changes')
+            return None
+        try:
+            inotify = INotify()
+            inotify.add_watch(Settings.get().snapshot_dir, flags.CLOSE_WRITE | flags.MOVED_TO)
+        except OSError as e:
+            warning(f'Cannot setup inotify ({e}), polling for changes')
+            return None
+        return inotify
+
+    def _wait_for_changes(self, inotify: Optional['INotify'], interval: int) -> Iterable[str]:
+        # Every item is polled at least once per interval, whatever inotify reports
+        wait = self._polled_at + interval - monotonic()
+        if inotify and wait > 0:
+            names = {e.name for e in inotify.read(timeout=int(wait * 1000))}
+            if monotonic() - self._polled_at < interval:
+                return names & self._items.keys()
+        self._polled_at = monotonic()
+        return list(self._items.keys())
+
+    async def run(self) -> None:
+        settings = Settings.get()
+        interval = settings.snapshot_watch_interval
+        if interval <= 0 and settings.workers > 1:
+            # Other workers' uploads and supply refreshes reach this worker only through the watcher
+            interval = Settings.__fields__['snapshot_watch_interval'].default
+            warning(f'Snapshots watching cannot be disabled with {settings.workers} workers, polling every {interval} seconds')
+        if interval <= 0:
+            info(f'Snapshots watching is disabled')
+            return
+        inotify = await run_in_threadpool(self._inotify)
+        while True:
+            if not inotify:
+                await asleep(interval)
+            changed = await run_in_threadpool(self._wait_for_changes, inotify, interval)
+            for name in changed:
+                for item in self._items[name]:
+                    await run_in_threadpool(item.sync)
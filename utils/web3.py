@@ -1,12 +1,15 @@
 from decimal import Decimal
-from typing import Any, Callable
+from typing import Any, Callable, Optional, Tuple, TYPE_CHECKING
 
 from time import sleep
 
-from functools import cache
+from functools import cache, lru_cache
 
-from web3 import Web3
-from web3.eth import Contract
+# web3 takes a while to import, so it is imported only by the code creating
+# Web3 instances, in the first supply refresh rather than on the app start
+if TYPE_CHECKING:
+    from web3 import Web3
+    from web3.eth import Contract
 
 from .settings import Settings
 from .logging import info, error
@@ -14,6 +17,17 @@ from .abi import ABI, get_abi
 
 __settings = Settings.get()
 
+# keccak('Transfer(address,address,uint256)')
+TRANSFER_TOPIC = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+ZERO_ADDRESS_TOPIC = '0x' + '00' * 32
+
+def _is_zero_address(topics: list, position: int) -> bool:
+    if len(topics) <= position:
+        return False
+    topic = topics[position]
+    # web3 returns topics as HexBytes
+    return int(topic.hex() if isinstance(topic, bytes) else topic, 16) == 0
+
 def make_web3_call(func: Callable, *args, **kwargs) -> Any:
     attempts = 0
     while attempts < __settings.web3_retry_attemtps:
@@ -29,9 +43,9 @@ def make_web3_call(func: Callable, *args, **kwargs) -> Any:
 #TODO make the class cachable for the same chain and token if different 
 #     objects of the class are created 
 class ERC20Token():
-    contract: Contract
+    contract: 'Contract'
 
-    def __init__(self, w3: Web3, address: str):
+    def __init__(self, w3: 'Web3', address: str):
         self.contract = w3.eth.contract(abi = get_abi(ABI.ERC20), address = address)
 
     @cache
@@ -41,8 +55,52 @@ class ERC20Token():
         info(f'Decimals {retval}')
         return retval
 
-    def totalSupply(self, normalize = True) -> Decimal:
-        retval = make_web3_call(self.contract.functions.totalSupply().call)
+    def block_number(self) -> int:
+        return make_web3_call(lambda: self.contract.web3.eth.block_number)
+
+    # A timestamp lookup needs a few dozen headers, the ones around the same
+    # dates (month ends) are requested again and again
+    @lru_cache(maxsize=4096)
+    def block_timestamp(self, block: int) -> int:
+        return make_web3_call(self.contract.web3.eth.get_block, block)['timestamp']
+
+    def block_at(self, timestamp: int, latest: int) -> Optional[int]:
+        """The last block mined at or before the timestamp, None if the chain started later"""
+        if self.block_timestamp(latest) <= timestamp:
+            return latest
+        if self.block_timestamp(0) > timestamp:
+            return None
+        # Binary search keeping timestamp(low) <= timestamp < timestamp(high)
+        low, high = 0, latest
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.block_timestamp(middle) <= timestamp:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def supply_changes(self, from_block: int) -> Tuple[Optional[int], bool]:
+        """Checks for mints (transfers from zero address) and burns (transfers to zero address)
+        from the block up to the latest one in a single RPC call
+
+        Returns the last block with a transfer (None if there were no transfers) and
+        whether mints or burns were found.
+        """
+        # Topics of different positions are ANDed by the filter, so all transfers are
+        # requested in one call and mints and burns are picked from them here
+        logs = make_web3_call(self.contract.web3.eth.get_logs, {
+            'address': self.contract.address,
+            'fromBlock': from_block,
+            'toBlock': 'latest',
+            'topics': [TRANSFER_TOPIC]
+        })
+        last_block = max([log['blockNumber'] for log in logs], default=None)
+        changed = any([_is_zero_address(log['topics'], 1) or _is_zero_address(log['topics'], 2) for log in logs])
+        return last_block, changed
+
+    def totalSupply(self, normalize = True, block_identifier = 'latest') -> Decimal:
+        retval = make_web3_call(self.contract.functions.totalSupply().call, block_identifier=block_identifier)
         if normalize:
             denominator_power = self.decimals()
             retval = Decimal(retval / 10 ** denominator_power)